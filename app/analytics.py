@@ -0,0 +1,116 @@
+"""Сводная статистика прохождения курсов для владельцев.
+
+Счетчики в MaterialStats, CourseUserStats и CourseCompletionStats меняются в той же
+транзакции, что и Progress, поэтому чтение статистики не трогает таблицу Progress
+и зависит только от числа материалов курса. Функции не делают commit.
+"""
+from sqlalchemy import select, update, delete, and_, func, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.db import Material, Progress, User, MaterialStats, CourseUserStats, CourseCompletionStats
+
+
+async def _move_student(course_id: int, old_completed: int, new_completed: int, session: AsyncSession):
+    if old_completed > 0:
+        query = update(CourseCompletionStats).where(and_(
+            CourseCompletionStats.course_id == course_id, CourseCompletionStats.completed == old_completed)
+        ).values(students=CourseCompletionStats.students - 1)
+        await session.execute(query)
+
+    query = sqlite_insert(CourseCompletionStats).values(course_id=course_id, completed=new_completed, students=1)
+    query = query.on_conflict_do_update(index_elements=['course_id', 'completed'],
+                                        set_={'students': CourseCompletionStats.students + 1})
+    await session.execute(query)
+
+async def _rebuild_distribution(course_id: int, session: AsyncSession):
+    await session.execute(delete(CourseCompletionStats).where(CourseCompletionStats.course_id == course_id))
+    distribution = (
+        select(CourseUserStats.course_id, CourseUserStats.completed, func.count())
+        .where(and_(CourseUserStats.course_id == course_id, CourseUserStats.completed > 0))
+        .group_by(CourseUserStats.completed)
+    )
+    await session.execute(sqlite_insert(CourseCompletionStats).from_select(['course_id', 'completed', 'students'], distribution))
+
+
+async def record_progress(user_id: int, course_id: int, material_ids: list[int], session: AsyncSession):
+    # вызывается с id материалов, по которым только что появились новые отметки
+    if not material_ids:
+        return
+
+    query = sqlite_insert(MaterialStats).values(
+        [{'material_id': material_id, 'course_id': course_id, 'completed': 1} for material_id in material_ids])
+    query = query.on_conflict_do_update(index_elements=['material_id'], set_={'completed': MaterialStats.completed + 1})
+    await session.execute(query)
+
+    added = len(material_ids)
+    query = sqlite_insert(CourseUserStats).values(course_id=course_id, user_id=user_id, completed=added)
+    query = query.on_conflict_do_update(index_elements=['course_id', 'user_id'],
+                                        set_={'completed': CourseUserStats.completed + added})
+    completed = (await session.execute(query.returning(CourseUserStats.completed))).scalar_one()
+
+    await _move_student(course_id, completed - added, completed, session)
+
+async def forget_material(course_id: int, material_id: int, session: AsyncSession):
+    # до удаления материала: у всех, кто его прошел, счетчик по курсу уменьшается на 1
+    completed_by = select(Progress.user_id).where(Progress.material_id == material_id)
+    query = update(CourseUserStats).where(and_(
+        CourseUserStats.course_id == course_id, CourseUserStats.user_id.in_(completed_by))
+    ).values(completed=CourseUserStats.completed - 1)
+    await session.execute(query)
+    # строка MaterialStats удалится каскадом вместе с материалом.
+    # Удаление материала - редкая операция, распределение проще пересчитать целиком
+    await _rebuild_distribution(course_id, session)
+
+async def forget_user(user_id: int, session: AsyncSession):
+    # до удаления пользователя: убираем его из статистики чужих курсов. Его собственные строки
+    # статистики и статистика его курсов удаляются каскадом вместе с пользователем
+    user_counts = select(CourseUserStats.course_id, CourseUserStats.completed).where(CourseUserStats.user_id == user_id)
+    query = update(CourseCompletionStats).where(
+        tuple_(CourseCompletionStats.course_id, CourseCompletionStats.completed).in_(user_counts)
+    ).values(students=CourseCompletionStats.students - 1)
+    await session.execute(query)
+
+    completed_materials = select(Progress.material_id).where(Progress.user_id == user_id)
+    query = update(MaterialStats).where(MaterialStats.material_id.in_(completed_materials)).values(
+        completed=MaterialStats.completed - 1)
+    await session.execute(query)
+
+
+async def get_material_funnel(course_id: int, session: AsyncSession):
+    query = (
+        select(Material.counter, Material.title, func.coalesce(MaterialStats.completed, 0).label('completed'))
+        .outerjoin(MaterialStats, MaterialStats.material_id == Material.id)
+        .where(Material.course_id == course_id)
+        .order_by(Material.position, Material.counter)
+    )
+    result = await session.execute(query)
+    return result.all()
+
+async def get_completion_distribution(course_id: int, session: AsyncSession):
+    query = (
+        select(CourseCompletionStats.completed, CourseCompletionStats.students)
+        .where(and_(CourseCompletionStats.course_id == course_id, CourseCompletionStats.students > 0))
+        .order_by(CourseCompletionStats.completed)
+    )
+    result = await session.execute(query)
+    return result.all()
+
+async def get_student_stats(course_id: int, cursor: int | None, limit: int, session: AsyncSession):
+    query = (
+        select(CourseUserStats.user_id, User.name, CourseUserStats.completed)
+        .join(User, User.id == CourseUserStats.user_id)
+        .where(and_(CourseUserStats.course_id == course_id, CourseUserStats.completed > 0))
+        .order_by(CourseUserStats.user_id)
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        query = query.where(CourseUserStats.user_id > cursor)
+    result = await session.execute(query)
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+    return rows, next_cursor
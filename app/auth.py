@@ -1,31 +1,112 @@
+import asyncio
 import datetime
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import bcrypt
 from fastapi import Depends, HTTPException, status
 import jwt
 from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import PyJWTError
+from sqlalchemy import delete
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.batch import after_commit
+from app.cache import TTLCache, cache_collector
 from app.crud import get_user_by_name
-from app.database.db import get_session
+from app.database.db import get_read_session, RefreshToken
+from app.metrics import bcrypt_duration, register_collector
 from app.models import UserResponse
+from app.purge import find_running
 
 SECRET_KEY='mysecretkey'
 ALGORITHM='HS256'
 ACCESS_TOKEN_EXPIRE_MINUTES=2
+REFRESH_TOKEN_EXPIRE_DAYS=int(os.getenv('REFRESH_TOKEN_EXPIRE_DAYS', 30))
+REFRESH_TOKEN_PRUNE_INTERVAL=float(os.getenv('REFRESH_TOKEN_PRUNE_INTERVAL', 3600))  # с
+
+BCRYPT_ROUNDS=int(os.getenv('BCRYPT_ROUNDS', 12))
+HASH_EXECUTOR=os.getenv('HASH_EXECUTOR', 'thread')  # thread или process
+HASH_WORKERS=int(os.getenv('HASH_WORKERS', 4))
+HASH_QUEUE_SIZE=int(os.getenv('HASH_QUEUE_SIZE', 32))
+HASH_RETRY_AFTER=int(os.getenv('HASH_RETRY_AFTER', 1))
+
+PRINCIPAL_CACHE_SIZE=int(os.getenv('PRINCIPAL_CACHE_SIZE', 10000))
+PRINCIPAL_CACHE_TTL=float(os.getenv('PRINCIPAL_CACHE_TTL', 60))
 
 
 oauth2_scheme=OAuth2PasswordBearer(tokenUrl='token')
+optional_oauth2_scheme=OAuth2PasswordBearer(tokenUrl='token', auto_error=False)
 
 def get_password_hash(password: str):
-    salt=bcrypt.gensalt()
+    salt=bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed=bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
 def verify_password(normal_password: str, hashed_password: str):
     return bcrypt.checkpw(normal_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+def password_needs_rehash(hashed_password: str):
+    # формат bcrypt: $2b$<cost>$<salt+hash>
+    try:
+        rounds=int(hashed_password.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds!=BCRYPT_ROUNDS
+
+
+class HashPool:
+    """Пул для bcrypt, чтобы хеширование не блокировало event loop.
+
+    Одновременно выполняется не больше workers задач, еще queue_size ждут в очереди.
+    Если очередь заполнена - сразу 503 с Retry-After, а не ожидание.
+    """
+
+    def __init__(self, kind: str, workers: int, queue_size: int):
+        self.kind=kind
+        self.workers=workers
+        self.limit=workers+queue_size
+        self.pending=0
+        self.executor=None
+
+    def start(self):
+        if self.executor is None:
+            executor_class=ProcessPoolExecutor if self.kind=='process' else ThreadPoolExecutor
+            self.executor=executor_class(max_workers=self.workers)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor=None
+
+    async def run(self, func, *args):
+        if self.pending>=self.limit:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Сервер перегружен, повторите позже',
+                                headers={'Retry-After': str(HASH_RETRY_AFTER)})
+        self.start()
+        self.pending+=1
+        started=time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending-=1
+            bcrypt_duration.observe(time.perf_counter()-started, func.__name__)
+
+    def collect(self):
+        yield 'hash_pool_pending', 'gauge', 'Задачи bcrypt в работе и в очереди', (), [((), self.pending)]
+
+
+hash_pool=HashPool(HASH_EXECUTOR, HASH_WORKERS, HASH_QUEUE_SIZE)
+register_collector(hash_pool.collect)
+
+async def hash_password(password: str):
+    return await hash_pool.run(get_password_hash, password)
+
+async def check_password(normal_password: str, hashed_password: str):
+    return await hash_pool.run(verify_password, normal_password, hashed_password)
+
 def create_token(data: dict):
     to_encode=data.copy()
     expire=datetime.datetime.now()+datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -38,30 +119,119 @@ async def verify_token(token: str):
     except PyJWTError:
         return None
 
-async def get_current_user(token: str= Depends(oauth2_scheme), db: AsyncSession=Depends(get_session)):
+# токен -> UserResponse, чтобы не ходить в БД за пользователем на каждый запрос
+principal_cache=TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+register_collector(cache_collector('principal_cache', 'Кеш токен -> пользователь', principal_cache))
+
+def invalidate_user(user_id: int):
+    principal_cache.delete_where(lambda user: user.id==user_id)
+    # в атомарном пакете /batch - еще раз после commit пакета: до него параллельный запрос
+    # мог снова закешировать пользователя, которого транзакция пакета уже удалила
+    after_commit(invalidate_user, user_id)
+
+def _ensure_not_purging(user_id: int):
+    # пока пользователя удаляют в фоне (app/purge.py), от его имени ничего не принимается
+    if find_running('user', user_id) is not None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Пользователь удаляется')
+
+async def get_current_user(token: str= Depends(oauth2_scheme), db: AsyncSession=Depends(get_read_session)):
+    cached=principal_cache.get(token)
+    if cached is not None:
+        _ensure_not_purging(cached.id)
+        return cached
+
     payload=await verify_token(token)
     if payload is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Не авторизован')
 
     name: str=payload.get('sub')
-    if name is None:
+    if name is None or payload.get('type')=='refresh':
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Не авторизован')
 
     user=await get_user_by_name(name, db)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Не авторизован')
 
+    _ensure_not_purging(user.id)
+    user=UserResponse.model_validate(user)
+    # запись в кеше не должна пережить сам токен
+    exp=payload.get('exp')
+    principal_cache.set(token, user, ttl=exp-time.time() if exp is not None else None)
+    return user
 
-    return UserResponse.model_validate(user)
+async def get_optional_user(token: str | None=Depends(optional_oauth2_scheme), db: AsyncSession=Depends(get_read_session)):
+    # для открытых эндпоинтов, которые с токеном отвечают по данным пользователя
+    if token is None:
+        return None
+    return await get_current_user(token, db)
 
 async def authentificate_user(session:AsyncSession, name:str, password:str):
     user=await get_user_by_name(name, session)
 
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await check_password(password, user.hashed_password):
         return False
+    _ensure_not_purging(user.id)
+
+    if password_needs_rehash(user.hashed_password):
+        # хеш с другой стоимостью - тихо пересчитываем, вход от этого не зависит
+        try:
+            user.hashed_password=await hash_password(password)
+            await session.commit()
+        except HTTPException:
+            pass
+        except Exception:
+            await session.rollback()
     return UserResponse.model_validate(user)
 
 
+_last_prune=0.0
+
+async def _prune_refresh_tokens(session: AsyncSession, now: datetime.datetime):
+    # истекшие строки удаляются не чаще раза в REFRESH_TOKEN_PRUNE_INTERVAL, вместе с выдачей нового токена
+    global _last_prune
+    if time.monotonic()-_last_prune<REFRESH_TOKEN_PRUNE_INTERVAL:
+        return
+    _last_prune=time.monotonic()
+    await session.execute(delete(RefreshToken).where(RefreshToken.expires_at<=now))
+
+async def create_refresh_token(user: UserResponse, session: AsyncSession):
+    jti=secrets.token_hex(16)
+    # в БД время UTC без часового пояса, в токене exp - тот же момент
+    now=datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    expire=now+datetime.timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+
+    await _prune_refresh_tokens(session, now)
+    session.add(RefreshToken(jti=jti, user_id=user.id, expires_at=expire))
+    await session.commit()
+
+    to_encode={'sub': user.name, 'uid': user.id, 'jti': jti, 'type': 'refresh', 'exp': expire.replace(tzinfo=datetime.timezone.utc)}
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+async def revoke_user_refresh_tokens(user_id: int, session: AsyncSession):
+    # без commit - вызывающий коммитит вместе со своими изменениями
+    await session.execute(delete(RefreshToken).where(RefreshToken.user_id==user_id))
+
+async def rotate_refresh_token(token: str, session: AsyncSession):
+    """Меняет refresh-токен на новый. Старый становится недействительным.
+
+    Повторное предъявление уже использованного токена считается утечкой -
+    отзываются все refresh-токены пользователя. Использованный токен узнается
+    по тому, что его строки в RefreshTokens уже нет.
+    """
+    payload=await verify_token(token)
+    if payload is None or payload.get('type')!='refresh' or payload.get('jti') is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Недействительный refresh токен')
+
+    jti=payload['jti']
+    user=UserResponse(id=payload['uid'], name=payload['sub'])
+    _ensure_not_purging(user.id)
+
+    result=await session.execute(delete(RefreshToken).where(RefreshToken.jti==jti))
+    if result.rowcount==1:
+        return user, await create_refresh_token(user, session)
 
+    await revoke_user_refresh_tokens(user.id, session)
+    await session.commit()
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Недействительный refresh токен')
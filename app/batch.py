@@ -0,0 +1,204 @@
+"""Выполнение пакета запросов POST /batch.
+
+Каждая операция пакета - обычный запрос к приложению через ASGI, без сети: те же
+маршруты, проверки и ошибки, что и у отдельного запроса. Заголовок Authorization
+берется из запроса пакета, пользователь уже в кеше авторизации, так что токен
+проверяется один раз на весь пакет.
+
+Без atomic подряд идущие GET выполняются параллельно, каждый в своей читающей
+сессии (в WAL читатели друг другу не мешают), изменяющие запросы - по порядку в
+одной общей сессии записи, каждый со своим commit.
+
+С atomic все операции выполняются по порядку в одной сессии поверх транзакции
+BEGIN IMMEDIATE (batch_engine). Сессия присоединена к ней в режиме create_savepoint:
+commit обработчика фиксирует только SAVEPOINT, а весь пакет фиксируется или
+откатывается целиком. После первой операции с кодом 400 и выше пакет откатывается,
+остальные операции не выполняются (424). События ленты изменений публикуются
+только после commit пакета, кеш ответов внутри пакета не читается и не пополняется:
+ответ мог бы увидеть незафиксированные данные. Фоновое удаление большого курса или пользователя
+(202) в транзакцию пакета не входит.
+"""
+import asyncio
+import contextvars
+import json
+from contextlib import contextmanager
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.db import batch_engine, session_maker
+
+# операции, которые нельзя выполнять в пакете: вложенный пакет и бесконечный поток событий
+FORBIDDEN_PREFIXES=('/batch', '/events')
+SKIPPED_STATUS=424
+
+
+class _Effects:
+    def __init__(self):
+        self.on_commit=[]
+        self.on_finish=[]
+
+
+_effects=contextvars.ContextVar('batch_effects', default=None)
+
+
+def after_commit(callback, *args):
+    """Внутри атомарного пакета откладывает callback(*args) до commit пакета и возвращает True.
+
+    При откате пакета callback не вызывается. Вне пакета возвращает False.
+    """
+    effects=_effects.get()
+    if effects is None:
+        return False
+    effects.on_commit.append((callback, args))
+    return True
+
+def after_finish(callback, *args):
+    # то же, но callback вызывается и после commit, и после отката пакета
+    effects=_effects.get()
+    if effects is None:
+        return False
+    effects.on_finish.append((callback, args))
+    return True
+
+
+def in_atomic_batch():
+    return _effects.get() is not None
+
+
+@contextmanager
+def _deferred_effects():
+    effects=_Effects()
+    token=_effects.set(effects)
+    try:
+        yield effects
+    finally:
+        _effects.reset(token)
+
+
+class Operation:
+    __slots__=('method', 'path', 'query', 'body')
+
+    def __init__(self, method: str, path: str, body):
+        self.method=method
+        self.path, _, self.query=path.partition('?')
+        self.body=b'' if body is None else json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _result(status: int, body: bytes=b'null'):
+    return b'{"status":'+str(status).encode()+b',"body":'+body+b'}'
+
+def _error(status: int, detail: str):
+    return _result(status, json.dumps({'detail': detail}, ensure_ascii=False).encode('utf-8'))
+
+
+async def _call(app, parent_scope, operation: Operation, sessions: dict):
+    """Одна операция через ASGI. Возвращает (код ответа, элемент результата в JSON)."""
+    if operation.path.startswith(FORBIDDEN_PREFIXES):
+        return 400, _error(400, f'{operation.path} нельзя вызвать в пакете')
+
+    headers=[(name, value) for name, value in parent_scope['headers'] if name==b'authorization']
+    headers+=[(b'content-type', b'application/json'), (b'content-length', str(len(operation.body)).encode())]
+    scope={
+        'type': 'http',
+        'asgi': parent_scope.get('asgi', {'version': '3.0'}),
+        'http_version': parent_scope.get('http_version', '1.1'),
+        'scheme': parent_scope.get('scheme', 'http'),
+        'server': parent_scope.get('server'),
+        'client': parent_scope.get('client'),
+        'root_path': parent_scope.get('root_path', ''),
+        'method': operation.method,
+        'path': operation.path,
+        'raw_path': operation.path.encode(),
+        'query_string': operation.query.encode(),
+        'headers': headers,
+        'batch_sessions': sessions,
+    }
+    if 'state' in parent_scope:
+        scope['state']=parent_scope['state'].copy()
+
+    request_sent=False
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent=True
+            return {'type': 'http.request', 'body': operation.body, 'more_body': False}
+        # клиент не отключается: ответ дочитывается до конца
+        await asyncio.Event().wait()
+
+    status=500
+    content_type=b''
+    chunks=[]
+    async def send(message):
+        nonlocal status, content_type
+        if message['type']=='http.response.start':
+            status=message['status']
+            content_type=next((value for name, value in message.get('headers', []) if name.lower()==b'content-type'), b'')
+        elif message['type']=='http.response.body':
+            chunks.append(message.get('body', b''))
+
+    try:
+        await app(scope, receive, send)
+    except Exception as e:
+        return 500, _error(500, str(e))
+
+    body=b''.join(chunks)
+    if not body:
+        return status, _result(status)
+    if content_type.startswith(b'application/json'):
+        # готовый JSON вставляется в ответ как есть, без разбора и повторной сериализации
+        return status, _result(status, body)
+    return status, _result(status, json.dumps(body.decode('utf-8', errors='replace'), ensure_ascii=False).encode('utf-8'))
+
+
+async def run_batch(app, parent_scope, operations: list[Operation], atomic: bool):
+    """Выполняет операции, возвращает (элементы результата в JSON, committed или None без atomic)."""
+    if atomic:
+        return await _run_atomic(app, parent_scope, operations)
+
+    results=[]
+    async with session_maker() as write_session:
+        index=0
+        while index<len(operations):
+            if operations[index].method=='GET':
+                group_end=index
+                while group_end<len(operations) and operations[group_end].method=='GET':
+                    group_end+=1
+                group=await asyncio.gather(*(_call(app, parent_scope, operation, {}) for operation in operations[index:group_end]))
+                results.extend(result for _, result in group)
+                index=group_end
+            else:
+                _, result=await _call(app, parent_scope, operations[index], {'write': write_session})
+                results.append(result)
+                # следующая операция читает строки заново, а не из identity map прошлой
+                write_session.expunge_all()
+                index+=1
+    return results, None
+
+
+async def _run_atomic(app, parent_scope, operations: list[Operation]):
+    results=[]
+    failed=False
+    with _deferred_effects() as effects:
+        async with batch_engine.connect() as connection:
+            await connection.begin()
+            session=AsyncSession(bind=connection, join_transaction_mode='create_savepoint', expire_on_commit=False)
+            session.info['batch_atomic']=True
+            try:
+                for operation in operations:
+                    if failed:
+                        results.append(_error(SKIPPED_STATUS, 'Не выполнено: предыдущая операция пакета завершилась ошибкой'))
+                        continue
+                    status, result=await _call(app, parent_scope, operation, {'write': session, 'read': session})
+                    results.append(result)
+                    failed=status>=400
+            finally:
+                await session.close()
+                if failed or len(results)<len(operations):
+                    await connection.rollback()
+                else:
+                    await connection.commit()
+
+    committed=not failed and len(results)==len(operations)
+    for callback, args in (effects.on_commit if committed else [])+effects.on_finish:
+        callback(*args)
+    return results, committed
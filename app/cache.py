@@ -0,0 +1,242 @@
+import hashlib
+import os
+import secrets
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from fastapi import Request, Response, status
+
+from app.batch import after_finish, in_atomic_batch
+from app.metrics import register_collector
+from app.serialization import dump_json
+
+
+class TTLCache:
+    """LRU-кеш в памяти процесса с ограничением по размеру и времени жизни записей."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize=maxsize
+        self.ttl=ttl
+        self.hits=0
+        self.misses=0
+        self._data=OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item=self._data.get(key)
+        if item is None:
+            self.misses+=1
+            return None
+
+        expires_at, value=item
+        if expires_at<=time.monotonic():
+            del self._data[key]
+            self.misses+=1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits+=1
+        return value
+
+    def set(self, key, value, ttl: float | None=None):
+        if ttl is None or ttl>self.ttl:
+            ttl=self.ttl
+        if ttl<=0 or self.maxsize<=0:
+            return
+
+        self._data[key]=(time.monotonic()+ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data)>self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        for key in [key for key, (_, value) in self._data.items() if predicate(value)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+def cache_collector(name: str, description: str, cache):
+    # метрики для /metrics из stats() кеша: попадания, промахи и размер, если он известен
+    def collect():
+        stats=cache.stats()
+        yield f'{name}_hits_total', 'counter', f'{description}: попадания', (), [((), stats['hits'])]
+        yield f'{name}_misses_total', 'counter', f'{description}: промахи', (), [((), stats['misses'])]
+        if 'size' in stats:
+            yield f'{name}_entries', 'gauge', f'{description}: записи', (), [((), stats['size'])]
+    return collect
+
+
+class MemoryBackend:
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache=TTLCache(maxsize, ttl)
+
+    def get(self, key: str):
+        return self._cache.get(key)
+
+    def set(self, key: str, value: tuple[str, bytes]):
+        self._cache.set(key, value)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class DiskBackend:
+    """Хранит ответы файлами в каталоге, а не в памяти процесса.
+
+    ETag содержит метку запуска процесса, поэтому файлы прошлых запусков уже не
+    совпадут ни с одним ETag и удаляются при старте. Суммарный размер файлов
+    ограничен max_bytes: сверх него удаляются давно не читанные ответы.
+    Каталог принадлежит одному процессу: второй процесс с тем же каталогом при
+    старте удалит чужие файлы.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory=Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes=max_bytes
+        self.hits=0
+        self.misses=0
+        self.size_bytes=0
+        self._sizes=OrderedDict()  # путь -> размер, от давно не читанных к недавним
+        for path in self.directory.iterdir():
+            # удаляются только файлы кеша: имя - sha1 ключа
+            if len(path.stem)==40 and path.suffix in ('', '.tmp') and path.is_file():
+                path.unlink(missing_ok=True)
+
+    def _path(self, key: str):
+        return self.directory / hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        path=self._path(key)
+        try:
+            data=path.read_bytes()
+        except OSError:
+            self.misses+=1
+            return None
+        if path in self._sizes:
+            self._sizes.move_to_end(path)
+        etag, _, body=data.partition(b'\n')
+        self.hits+=1
+        return etag.decode('utf-8'), body
+
+    def set(self, key: str, value: tuple[str, bytes]):
+        etag, body=value
+        data=etag.encode('utf-8')+b'\n'+body
+        if len(data)>self.max_bytes:
+            return
+        path=self._path(key)
+        tmp_path=path.with_suffix('.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+        self.size_bytes+=len(data)-self._sizes.pop(path, 0)
+        self._sizes[path]=len(data)
+        while self.size_bytes>self.max_bytes:
+            old_path, size=self._sizes.popitem(last=False)
+            old_path.unlink(missing_ok=True)
+            self.size_bytes-=size
+
+    def stats(self):
+        return {'directory': str(self.directory), 'size': len(self._sizes), 'bytes': self.size_bytes,
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def etag_matches(etag: str, if_none_match: str | None):
+    """Сравнение с If-None-Match: список ETag через запятую, * или слабые W/"..." (слабое сравнение, RFC 9110)."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate=candidate.strip()
+        if candidate=='*':
+            return True
+        if candidate.startswith('W/'):
+            candidate=candidate[2:]
+        if candidate==etag:
+            return True
+    return False
+
+
+class ResponseCache:
+    """Кеш готовых JSON-ответов для чтения курсов и материалов.
+
+    У каждого курса есть счетчик версий, он увеличивается при любом изменении курса
+    или его материалов. ETag строится из счетчика, поэтому на If-None-Match можно
+    ответить 304, не обращаясь к БД. Ключ ALL относится к спискам по всем курсам.
+
+    Счетчики версий и метка запуска живут в памяти процесса: при нескольких
+    процессах сервера изменение в одном не сбрасывает кеш и ETag остальных, и они
+    продолжают отдавать старые ответы. Кеш рассчитан на запуск в одном процессе,
+    иначе его надо выключить (RESPONSE_CACHE_BACKEND=none).
+    """
+
+    ALL='*'
+
+    def __init__(self, backend):
+        self.backend=backend
+        self._boot=secrets.token_hex(4)
+        self._versions={}
+
+    def etag(self, scope):
+        if isinstance(scope, tuple):
+            # ответ по нескольким курсам меняется при изменении любого из них
+            versions=','.join(f'{course_id}:{self._versions.get(course_id, 0)}' for course_id in scope)
+            return f'"{self._boot}-{hashlib.sha1(versions.encode()).hexdigest()[:16]}"'
+        return f'"{self._boot}-{scope}-{self._versions.get(scope, 0)}"'
+
+    def invalidate(self, *course_ids: int):
+        for scope in (*course_ids, self.ALL):
+            self._versions[scope]=self._versions.get(scope, 0)+1
+        # в атомарном пакете /batch ответы, собранные до конца транзакции, могли увидеть
+        # незафиксированные данные: версии сдвигаются еще раз после commit или отката
+        after_finish(self.invalidate, *course_ids)
+
+    async def respond(self, request: Request, key: str, scope, response_model, build, media_type: str='application/json'):
+        # response_model=None - build сам возвращает готовое тело в байтах
+        if in_atomic_batch():
+            # внутри атомарного пакета /batch данные еще не зафиксированы: без кеша и без ETag
+            body=await build()
+            return Response(content=body if response_model is None else dump_json(response_model, body), media_type=media_type)
+
+        etag=self.etag(scope)
+        if etag_matches(etag, request.headers.get('if-none-match')):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        body=None
+        if self.backend is not None:
+            cached=self.backend.get(key)
+            if cached is not None and cached[0]==etag:
+                body=cached[1]
+
+        if body is None:
+            body=await build()
+            if response_model is not None:
+                body=dump_json(response_model, body)
+            if self.backend is not None:
+                self.backend.set(key, (etag, body))
+
+        return Response(content=body, media_type=media_type, headers={'ETag': etag})
+
+
+def make_response_cache():
+    backend=os.getenv('RESPONSE_CACHE_BACKEND', 'memory')  # memory, disk или none
+    if backend=='disk':
+        return ResponseCache(DiskBackend(os.getenv('RESPONSE_CACHE_DIR', 'cache'), int(os.getenv('RESPONSE_CACHE_DISK_BYTES', 512*1024*1024))))
+    if backend=='none':
+        return ResponseCache(None)
+    return ResponseCache(MemoryBackend(int(os.getenv('RESPONSE_CACHE_SIZE', 5000)), float(os.getenv('RESPONSE_CACHE_TTL', 3600))))
+
+
+response_cache=make_response_cache()
+if response_cache.backend is not None:
+    register_collector(cache_collector('response_cache', 'Кеш ответов', response_cache.backend))
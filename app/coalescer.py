@@ -0,0 +1,180 @@
+"""Групповой commit для частых записей: отметок прогресса и новых материалов.
+
+Каждый commit в SQLite - это fsync и очередь за блокировкой записи. При включенном
+WRITE_COALESCE записи из параллельных запросов ставятся в очередь, и отдельная
+задача выполняет их пачкой в одной транзакции: до WRITE_COALESCE_MAX_BATCH записей
+или сколько набралось за WRITE_COALESCE_MAX_DELAY мс. Каждая запись идет в своем
+SAVEPOINT, поэтому ошибка одной откатывает только ее, а вызывающий получает свой
+результат или свое исключение.
+"""
+import asyncio
+import os
+import time
+
+from fastapi import HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.database.db import DATABASE_URL, make_engine
+from app.metrics import register_collector
+
+WRITE_COALESCE=os.getenv('WRITE_COALESCE', '0')=='1'
+WRITE_COALESCE_MAX_BATCH=int(os.getenv('WRITE_COALESCE_MAX_BATCH', 200))
+WRITE_COALESCE_MAX_DELAY=float(os.getenv('WRITE_COALESCE_MAX_DELAY', 5))  # мс
+WRITE_COALESCE_QUEUE_SIZE=int(os.getenv('WRITE_COALESCE_QUEUE_SIZE', 10000))
+WRITE_COALESCE_RETRY_AFTER=int(os.getenv('WRITE_COALESCE_RETRY_AFTER', 1))
+
+# границы корзин для распределения размеров пачек
+BATCH_SIZE_BUCKETS=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class WriteCoalescer:
+    def __init__(self, enabled: bool, max_batch: int, max_delay_ms: float, queue_size: int):
+        self.enabled=enabled
+        self.max_batch=max_batch
+        self.max_delay=max_delay_ms/1000
+        self.queue_size=queue_size
+        self._queue=None
+        self._task=None
+        self._engine=None
+        self._session_maker=None
+
+        self.batches=0
+        self.items=0
+        self.errors=0
+        self.batch_sizes={bucket: 0 for bucket in BATCH_SIZE_BUCKETS}
+        self.max_batch_seen=0
+        self.wait_seconds_total=0.0
+        self.wait_seconds_max=0.0
+        self.commit_seconds_total=0.0
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        # отдельное соединение-писатель: BEGIN IMMEDIATE и SAVEPOINT внутри общей транзакции
+        self._engine=make_engine(DATABASE_URL, 1, immediate=True, name='coalesce')
+        self._session_maker=async_sessionmaker(bind=self._engine, expire_on_commit=False)
+        self._queue=asyncio.Queue(maxsize=self.queue_size)
+        self._task=asyncio.create_task(self._worker())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # None в очереди - сигнал остановки: все, что поставлено до него, будет записано
+        await self._queue.put(None)
+        await self._task
+        self._task=None
+        await self._engine.dispose()
+
+    async def run(self, op, session: AsyncSession):
+        """Выполняет op(session) и коммитит.
+
+        При выключенном объединении - в сессии запроса, иначе - в общей пачке на
+        сессии писателя. op не должен сам делать commit.
+        """
+        if self._task is None or session.info.get('batch_atomic'):
+            # в атомарном пакете /batch запись идет в транзакции пакета.
+            # Читающую часть запроса закрываем: запись должна начать новую транзакцию
+            if session.in_transaction():
+                await session.commit()
+            result=await op(session)
+            await session.commit()
+            return result
+
+        future=asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((op, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Сервер перегружен, повторите позже',
+                                headers={'Retry-After': str(WRITE_COALESCE_RETRY_AFTER)})
+        return await future
+
+    async def _worker(self):
+        loop=asyncio.get_running_loop()
+        stopping=False
+        while not stopping:
+            item=await self._queue.get()
+            if item is None:
+                return
+            batch=[item]
+            deadline=loop.time()+self.max_delay
+            while len(batch)<self.max_batch:
+                if not self._queue.empty():
+                    item=self._queue.get_nowait()
+                else:
+                    timeout=deadline-loop.time()
+                    if timeout<=0:
+                        break
+                    try:
+                        item=await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping=True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def _commit(self, batch: list):
+        started=time.perf_counter()
+        done=[]
+        async with self._session_maker() as session:
+            for op, future, enqueued_at in batch:
+                wait=started-enqueued_at
+                self.wait_seconds_total+=wait
+                self.wait_seconds_max=max(self.wait_seconds_max, wait)
+                if future.done():  # запрос уже отменен
+                    continue
+                try:
+                    async with session.begin_nested():
+                        result=await op(session)
+                    done.append((future, result))
+                except Exception as e:
+                    self.errors+=1
+                    if not future.done():
+                        future.set_exception(e)
+
+            try:
+                await session.commit()
+            except Exception as e:
+                self.errors+=len(done)
+                for future, _ in done:
+                    if not future.done():
+                        future.set_exception(e)
+                done=[]
+
+        for future, result in done:
+            if not future.done():
+                future.set_result(result)
+
+        self.commit_seconds_total+=time.perf_counter()-started
+        self.batches+=1
+        self.items+=len(batch)
+        self.max_batch_seen=max(self.max_batch_seen, len(batch))
+        bucket=next((bucket for bucket in BATCH_SIZE_BUCKETS if len(batch)<=bucket), BATCH_SIZE_BUCKETS[-1])
+        self.batch_sizes[bucket]+=1
+
+    def stats(self):
+        return {
+            'enabled': self._task is not None,
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'batches': self.batches,
+            'items': self.items,
+            'errors': self.errors,
+            'avg_batch_size': self.items/self.batches if self.batches else 0,
+            'max_batch_size': self.max_batch_seen,
+            'batch_sizes': {f'le_{bucket}': count for bucket, count in self.batch_sizes.items()},
+            'avg_queue_wait_ms': self.wait_seconds_total/self.items*1000 if self.items else 0,
+            'max_queue_wait_ms': self.wait_seconds_max*1000,
+            'avg_commit_ms': self.commit_seconds_total/self.batches*1000 if self.batches else 0,
+        }
+
+    def collect(self):
+        yield 'write_coalesce_batches_total', 'counter', 'Транзакции группового commit', (), [((), self.batches)]
+        yield 'write_coalesce_items_total', 'counter', 'Записи, выполненные в пачках', (), [((), self.items)]
+        yield 'write_coalesce_errors_total', 'counter', 'Записи, завершившиеся ошибкой', (), [((), self.errors)]
+        yield 'write_coalesce_queue_depth', 'gauge', 'Записи в очереди', (), \
+            [((), self._queue.qsize() if self._queue is not None else 0)]
+
+
+write_coalescer=WriteCoalescer(WRITE_COALESCE, WRITE_COALESCE_MAX_BATCH, WRITE_COALESCE_MAX_DELAY, WRITE_COALESCE_QUEUE_SIZE)
+register_collector(write_coalescer.collect)
@@ -1,8 +1,16 @@
+import datetime
+
 from fastapi.params import Depends
-from sqlalchemy import select, and_, func
+from sqlalchemy import select, and_, func, insert, update, literal, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, undefer
 
-from app.database.db import User, get_session, Course, Material, Progress
+from app.database.db import User, get_session, get_read_session, Course, Material, Progress, CourseUserStats
+from app.database.ordering import POSITION_STEP, positions_between
+from app.models import MaterialCreate
+from app.analytics import record_progress
+from app.search import index_materials
 
 
 async def get_user_by_name(username:str, session:AsyncSession=Depends(get_session)):
@@ -25,8 +33,10 @@ async def get_course_by_id(course_id:int, session:AsyncSession=Depends(get_sessi
     course = result.scalar_one_or_none()
     return course
 
-async def get_material_by_counter(course_id:int, material_counter:int, session:AsyncSession=Depends(get_session)):
+async def get_material_by_counter(course_id:int, material_counter:int, session:AsyncSession=Depends(get_session), with_content:bool=False):
     query = select(Material).where(and_(Material.course_id == course_id, Material.counter==material_counter))
+    if with_content:
+        query = query.options(undefer(Material.content))
     result = await session.execute(query)
     material = result.scalar_one_or_none()
     return material
@@ -43,6 +53,280 @@ async def get_progress_user_material(user_id: int, material_id: int, session:Asy
     progress = result.scalar_one_or_none()
     return progress
 
+async def get_courses_page(cursor:int | None, limit:int, session:AsyncSession=Depends(get_session)):
+    # keyset-пагинация по Course.id, владелец подтягивается тем же запросом
+    query = (
+        select(Course.id, Course.title, Course.description, Course.owner_id, User.name.label('owner_name'))
+        .join(User, Course.owner_id == User.id)
+        .order_by(Course.id)
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        query = query.where(Course.id > cursor)
+    result = await session.execute(query)
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+async def get_user_with_courses(user_id:int, session:AsyncSession=Depends(get_session)):
+    query = select(User).options(joinedload(User.courses)).where(User.id == user_id)
+    result = await session.execute(query)
+    user = result.unique().scalar_one_or_none()
+    return user
+
+async def insert_materials(course_id:int, materials:list[MaterialCreate], session:AsyncSession=Depends(get_session),
+                           after:int | None=None, before:int | None=None):
+    # commit делает вызывающий (WriteCoalescer.run). Номер первого материала считается
+    # внутри INSERT, поэтому MAX и вставка идут под одной блокировкой записи и параллельные запросы не получат одинаковые номера. Остальные
+    # номера идут подряд за первым и вставляются одним executemany в той же транзакции.
+    # Материалы встают в конец курса или после материала after / перед материалом before,
+    # None - такого материала нет
+    first, *rest = materials
+    if after is None and before is None:
+        positions = None
+        first_position = select(func.coalesce(func.max(Material.position), 0) + POSITION_STEP).where(Material.course_id == course_id).scalar_subquery()
+    else:
+        placed = await material_positions(course_id, len(materials), after, before, None, session)
+        if placed is None:
+            return None
+        positions = placed[0]
+        first_position = positions[0]
+
+    next_counter = select(func.coalesce(func.max(Material.counter), 0) + 1).where(Material.course_id == course_id).scalar_subquery()
+    query = insert(Material).values(**first.model_dump(), course_id=course_id, counter=next_counter, position=first_position) \
+        .returning(Material.id, Material.counter, Material.position)
+    result = await session.execute(query)
+    material_id, first_counter, position = result.one()
+    created = [(material_id, first_counter)]
+    if positions is None:
+        positions = [position + POSITION_STEP * i for i in range(len(materials))]
+
+    if rest:
+        rows = [
+            {**material.model_dump(), 'course_id': course_id, 'counter': first_counter + i, 'position': positions[i]}
+            for i, material in enumerate(rest, 1)
+        ]
+        query = insert(Material).returning(Material.id, Material.counter, sort_by_parameter_order=True)
+        result = await session.execute(query, rows)
+        created.extend(tuple(row) for row in result.all())
+
+    await index_materials([
+        {'id': material_id, 'course_id': course_id, 'title': material.title, 'content': material.content}
+        for (material_id, _), material in zip(created, materials)
+    ], session)
+    return created
+
+async def _material_slot(course_id:int, after:int | None, before:int | None, exclude_id:int | None, session:AsyncSession):
+    # соседи места после материала after или перед материалом before: строки (position, counter),
+    # None - край курса. Каждый сосед ищется по индексу (course_id, position, counter).
+    # Без after и before - место в конце курса. None вместо пары - такого материала нет
+    scope = Material.course_id == course_id
+    if exclude_id is not None:
+        scope = and_(scope, Material.id != exclude_id)
+    key = tuple_(Material.position, Material.counter)
+
+    if after is None and before is None:
+        query = select(Material.position, Material.counter).where(scope).order_by(Material.position.desc(), Material.counter.desc()).limit(1)
+        return (await session.execute(query)).one_or_none(), None
+
+    query = select(Material.position, Material.counter).where(and_(scope, Material.counter == (after if after is not None else before)))
+    anchor = (await session.execute(query)).one_or_none()
+    if anchor is None:
+        return None
+    if after is not None:
+        query = select(Material.position, Material.counter).where(and_(scope, key > tuple_(*anchor))).order_by(Material.position, Material.counter).limit(1)
+        return anchor, (await session.execute(query)).one_or_none()
+    query = select(Material.position, Material.counter).where(and_(scope, key < tuple_(*anchor))).order_by(Material.position.desc(), Material.counter.desc()).limit(1)
+    return (await session.execute(query)).one_or_none(), anchor
+
+async def rebalance_positions(course_id:int, session:AsyncSession=Depends(get_session)):
+    # позиции курса заново с шагом POSITION_STEP в текущем порядке, одним UPDATE ... FROM
+    ranked = select(
+        Material.id, (func.row_number().over(order_by=(Material.position, Material.counter)) * POSITION_STEP).label('position')
+    ).where(Material.course_id == course_id).subquery()
+    query = update(Material).where(Material.id == ranked.c.id).values(position=ranked.c.position)
+    await session.execute(query.execution_options(synchronize_session=False))
+
+async def material_positions(course_id:int, count:int, after:int | None, before:int | None, exclude_id:int | None,
+                             session:AsyncSession=Depends(get_session)):
+    # (count позиций, сосед до, сосед после) для вставки или переноса. Обычно место есть и
+    # перенумерация не нужна, иначе курс перенумеровывается и соседи ищутся еще раз
+    for _ in range(2):
+        slot = await _material_slot(course_id, after, before, exclude_id, session)
+        if slot is None:
+            return None
+        prev, following = slot
+        positions = positions_between(prev and prev.position, following and following.position, count)
+        if positions is not None:
+            return positions, prev, following
+        await rebalance_positions(course_id, session)
+    raise ValueError(f'Между соседними материалами не помещается {count} материалов')
+
+async def move_material(course_id:int, material_id:int, after:int | None, before:int | None, session:AsyncSession=Depends(get_session)):
+    # меняется одна строка - позиция переносимого материала. Возвращает номера новых соседей
+    # (до, после), None - край курса. None вместо пары - материала after/before нет. commit делает вызывающий
+    placed = await material_positions(course_id, 1, after, before, material_id, session)
+    if placed is None:
+        return None
+    [position], prev, following = placed
+    query = update(Material).where(Material.id == material_id).values(position=position)
+    await session.execute(query.execution_options(synchronize_session=False))
+    return prev and prev.counter, following and following.counter
+
+def _materials_query(fields:tuple[str, ...], course_id:int | None, date_from:datetime.date | None, date_to:datetime.date | None):
+    # только нужные колонки, без ORM-объектов: content не читается, если его не просили
+    query = select(*[getattr(Material, name) for name in fields])
+    if course_id is not None:
+        query = query.where(Material.course_id == course_id)
+    if date_from is not None:
+        query = query.where(Material.date_lesson >= date_from)
+    if date_to is not None:
+        query = query.where(Material.date_lesson <= date_to)
+    return query
+
+async def get_materials(fields:tuple[str, ...], course_id:int | None, date_from:datetime.date | None, date_to:datetime.date | None,
+                        session:AsyncSession=Depends(get_session), limit:int | None=None):
+    result = await session.execute(_materials_query(fields, course_id, date_from, date_to).limit(limit))
+    return result.all()
+
+async def stream_materials(fields:tuple[str, ...], course_id:int | None, date_from:datetime.date | None, date_to:datetime.date | None,
+                           batch_size:int, session:AsyncSession=Depends(get_session)):
+    # серверный курсор: в памяти одновременно не больше batch_size строк
+    query = _materials_query(fields, course_id, date_from, date_to).execution_options(yield_per=batch_size)
+    result = await session.stream(query)
+    async for rows in result.partitions():
+        yield rows
+
+async def mark_progress(user_id:int, course_id:int, counters:list[int], session:AsyncSession=Depends(get_session)):
+    # один INSERT ... SELECT ... ON CONFLICT DO NOTHING по уникальному (user_id, material_id):
+    # уже отмеченные материалы пропускаются без предварительной проверки и без гонок.
+    # Возвращает (id, material_id) только для новых отметок и обновляет по ним статистику,
+    # commit делает вызывающий
+    materials = select(literal(user_id), Material.id, literal(True)).where(
+        and_(Material.course_id == course_id, Material.counter.in_(counters)))
+    query = (
+        sqlite_insert(Progress)
+        .from_select(['user_id', 'material_id', 'completed'], materials)
+        .on_conflict_do_nothing(index_elements=['user_id', 'material_id'])
+        .returning(Progress.id, Progress.material_id)
+    )
+    result = await session.execute(query)
+    created = result.all()
+    await record_progress(user_id, course_id, [material_id for _, material_id in created], session)
+    return created
+
+async def get_material_content(course_id:int, material_counter:int, session:AsyncSession=Depends(get_session)):
+    query = select(Material.content).where(and_(Material.course_id == course_id, Material.counter == material_counter))
+    result = await session.execute(query)
+    return result.scalar_one_or_none()
+
+async def get_material_ids_by_counters(course_id:int, counters:list[int], session:AsyncSession=Depends(get_session)):
+    query = select(Material.counter, Material.id).where(and_(Material.course_id == course_id, Material.counter.in_(counters)))
+    result = await session.execute(query)
+    return dict(result.all())
+
+async def count_course_progress(user_id:int, course_id:int, session:AsyncSession=Depends(get_session)):
+    # (пройдено, всего) одним запросом: материалы курса с LEFT JOIN на отметки пользователя
+    query = (
+        select(func.count(Progress.id), func.count(Material.id))
+        .select_from(Material)
+        .outerjoin(Progress, and_(Progress.material_id == Material.id, Progress.user_id == user_id))
+        .where(Material.course_id == course_id)
+    )
+    result = await session.execute(query)
+    return result.one()
+
+async def get_progress_dashboard(user_id:int, session:AsyncSession=Depends(get_session)):
+    # все курсы, где у пользователя есть хотя бы одна отметка, одним GROUP BY
+    touched = select(Material.course_id).join(Progress, Progress.material_id == Material.id).where(Progress.user_id == user_id)
+    query = (
+        select(Course.id.label('course_id'), Course.title,
+               func.count(Progress.id).label('completed'), func.count(Material.id).label('total'))
+        .join(Material, Material.course_id == Course.id)
+        .outerjoin(Progress, and_(Progress.material_id == Material.id, Progress.user_id == user_id))
+        .where(Course.id.in_(touched))
+        .group_by(Course.id)
+        .order_by(Course.id)
+    )
+    result = await session.execute(query)
+    return result.all()
+
+async def get_progress_course_ids(user_id:int, session:AsyncSession=Depends(get_session)):
+    # курсы, где у пользователя есть отметки, - по статистике, без обхода Progress
+    query = select(CourseUserStats.course_id).where(and_(CourseUserStats.user_id == user_id, CourseUserStats.completed > 0))
+    result = await session.execute(query)
+    return result.scalars().all()
+
+async def get_upcoming_lessons(course_ids:list[int], date_from:datetime.date, date_to:datetime.date, session:AsyncSession=Depends(get_session)):
+    # по индексу (date_lesson, course_id) для узкого окна или (course_id, date_lesson) для
+    # нескольких курсов - SQLite выбирает сам
+    query = (
+        select(Material.id, Material.course_id, Course.title.label('course_title'), Material.counter, Material.title, Material.date_lesson)
+        .join(Course, Course.id == Material.course_id)
+        .where(and_(Material.course_id.in_(course_ids), Material.date_lesson >= date_from, Material.date_lesson <= date_to))
+        .order_by(Material.date_lesson, Material.course_id, Material.counter)
+    )
+    result = await session.execute(query)
+    return result.all()
+
+
+class RequestLoader:
+    """Загрузчик в рамках одного запроса, по образцу DataLoader.
+
+    Запоминает найденные (и не найденные) курсы, материалы и пользователей по ключу,
+    так что зависимости и обработчик одного запроса не выбирают одну и ту же строку
+    дважды, а несколько ключей достаются одним запросом с IN.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self._courses = {}
+        self._materials = {}
+        self._users = {}
+
+    async def _load(self, cache: dict, keys, query_for_missing, key_of):
+        missing = [key for key in dict.fromkeys(keys) if key not in cache]
+        if missing:
+            result = await self.session.execute(query_for_missing(missing))
+            for key in missing:
+                cache[key] = None
+            for row in result.scalars().all():
+                cache[key_of(row)] = row
+        return {key: cache[key] for key in keys}
+
+    async def courses(self, course_ids: list[int]):
+        return await self._load(self._courses, course_ids,
+                                lambda ids: select(Course).where(Course.id.in_(ids)),
+                                lambda course: course.id)
+
+    async def course(self, course_id: int):
+        return (await self.courses([course_id]))[course_id]
+
+    async def materials(self, keys: list[tuple[int, int]]):
+        # ключ - (course_id, counter)
+        return await self._load(self._materials, keys,
+                                lambda keys: select(Material).where(tuple_(Material.course_id, Material.counter).in_(keys)),
+                                lambda material: (material.course_id, material.counter))
+
+    async def material(self, course_id: int, counter: int):
+        return (await self.materials([(course_id, counter)]))[(course_id, counter)]
+
+    async def users(self, user_ids: list[int]):
+        return await self._load(self._users, user_ids,
+                                lambda ids: select(User).where(User.id.in_(ids)),
+                                lambda user: user.id)
+
+    async def user(self, user_id: int):
+        return (await self.users([user_id]))[user_id]
 
 
+async def get_loader(session:AsyncSession=Depends(get_session)):
+    # сессия та же, что и у обработчика: FastAPI кеширует зависимости в пределах запроса
+    return RequestLoader(session)
 
+async def get_read_loader(session:AsyncSession=Depends(get_read_session)):
+    return RequestLoader(session)
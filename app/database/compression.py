@@ -0,0 +1,25 @@
+"""Сжатие длинных текстов для хранения в SQLite.
+
+Короткий текст хранится как есть (TEXT), длинный - сжатым zlib (BLOB). По типу
+значения в колонке понятно, как его читать, поэтому старые несжатые строки
+читаются без миграции данных.
+"""
+import os
+import zlib
+
+CONTENT_COMPRESS_MIN=int(os.getenv('CONTENT_COMPRESS_MIN', 1024))  # байты UTF-8, короче - без сжатия
+CONTENT_COMPRESS_LEVEL=int(os.getenv('CONTENT_COMPRESS_LEVEL', 6))
+
+
+def compress_text(value: str):
+    data=value.encode('utf-8')
+    if len(data)<CONTENT_COMPRESS_MIN:
+        return value
+    compressed=zlib.compress(data, CONTENT_COMPRESS_LEVEL)
+    # несжимаемый текст не стоит хранить в BLOB
+    return compressed if len(compressed)<len(data) else value
+
+def decompress_text(value: str | bytes):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
@@ -1,9 +1,16 @@
 from datetime import datetime
 import os
 from pathlib import Path
-from sqlalchemy import Integer, String, Boolean, ForeignKey, Text, Date
+from sqlalchemy import Integer, String, Boolean, ForeignKey, Text, Date, DateTime, Index, TypeDecorator, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from starlette.requests import Request
+
+from app.database.compression import compress_text, decompress_text
+from app.database.migrations import upgrade
+from app.metrics import METRICS, TimedQueuePool, instrument_engine
+from app import querylog
 
 
 BASE_DIR = Path(__file__).parent.parent  # поднимитесь на нужный уровень
@@ -12,9 +19,84 @@ DATABASE_PATH = BASE_DIR / "database" / "database.db"
 
 os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
 
-engine = create_async_engine(f"sqlite+aiosqlite:///{DATABASE_PATH}")
+DATABASE_URL = os.getenv('DATABASE_URL', f"sqlite+aiosqlite:///{DATABASE_PATH}")
+
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),  # мс
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024)),  # отрицательное значение - в КиБ
+    'foreign_keys': 'ON',  # без этого SQLite не выполняет ON DELETE CASCADE
+}
+
+
+def make_engine(url: str, pool_size: int, readonly: bool=False, immediate: bool=False, name: str | None=None):
+    """Движок с настройками SQLite: WAL, pragmas на каждое соединение.
+
+    readonly-движок включает query_only, через него идут GET-запросы: в режиме WAL
+    читатели не ждут писателя и не блокируют его.
+
+    immediate-движок сам открывает транзакцию BEGIN IMMEDIATE: блокировка записи берется
+    сразу, а SAVEPOINT работает внутри общей транзакции. Без этого драйвер начинает
+    транзакцию только перед DML, и первый SAVEPOINT коммитится отдельно.
+    """
+    # имя движка в метриках
+    name = name or ('read' if readonly else 'immediate' if immediate else 'write')
+    if make_url(url).database in (None, '', ':memory:'):
+        # для базы в памяти SQLAlchemy сам выбирает пул с единственным соединением
+        engine = create_async_engine(url)
+    else:
+        pool_options = {'poolclass': TimedQueuePool, 'pool_logging_name': name} if METRICS else {}
+        engine = create_async_engine(url, pool_size=pool_size, max_overflow=pool_size, **pool_options)
+    if METRICS:
+        instrument_engine(engine, name)
+    querylog.instrument_engine(engine)
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    pragmas = dict(SQLITE_PRAGMAS)
+    if readonly:
+        # journal_mode переключает писатель, читателю достаточно увидеть WAL
+        pragmas.pop('journal_mode')
+        pragmas['query_only'] = 'ON'
+
+    @event.listens_for(engine.sync_engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+        if immediate:
+            dbapi_connection.isolation_level = None
+
+    if immediate:
+        @event.listens_for(engine.sync_engine, 'begin')
+        def begin_immediate(conn):
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
+
+
+engine = make_engine(DATABASE_URL, int(os.getenv('DB_POOL_SIZE', 5)))
+read_engine = make_engine(DATABASE_URL, int(os.getenv('DB_READ_POOL_SIZE', 10)), readonly=True)
+# атомарные пакеты /batch: вся пачка - одна транзакция BEGIN IMMEDIATE, см. app/batch.py
+batch_engine = make_engine(DATABASE_URL, int(os.getenv('DB_BATCH_POOL_SIZE', 2)), immediate=True, name='batch')
 
 session_maker=async_sessionmaker(bind=engine, expire_on_commit=False)
+read_session_maker=async_sessionmaker(bind=read_engine, expire_on_commit=False)
+
+
+class CompressedText(TypeDecorator):
+    # в Python - str, в базе длинные значения сжаты zlib, см. app/database/compression.py
+    impl=Text
+    cache_ok=True
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value) if value is not None else None
 
 
 class Base(DeclarativeBase):
@@ -28,54 +110,133 @@ class User(Base):
     name: Mapped[str] = mapped_column(String, unique=True)
     hashed_password: Mapped[str] = mapped_column(String)
 
-    courses:Mapped[list['Course']]=relationship('Course', back_populates='owner', cascade='all, delete-orphan')
-    progress: Mapped[list['Progress']] = relationship('Progress', back_populates='user', cascade='all, delete-orphan')
+    courses:Mapped[list['Course']]=relationship('Course', back_populates='owner', cascade='all, delete-orphan', passive_deletes=True)
+    progress: Mapped[list['Progress']] = relationship('Progress', back_populates='user', cascade='all, delete-orphan', passive_deletes=True)
 
 class Course(Base):
     __tablename__ = 'Courses'
+    __table_args__ = (
+        Index('ix_courses_owner_id', 'owner_id'),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String)
     description: Mapped[str] = mapped_column(Text)
-    owner_id: Mapped[int] = mapped_column(Integer, ForeignKey('Users.id'))
+    owner_id: Mapped[int] = mapped_column(Integer, ForeignKey('Users.id', ondelete='CASCADE'))
 #    date_start: Mapped[datetime.date] = mapped_column(Date)
 #    date_end: Mapped[datetime.date] = mapped_column(Date)
 
     owner:Mapped['User']=relationship('User', back_populates='courses')
-    materials: Mapped[list['Material']] = relationship('Material', back_populates='course', cascade='all, delete-orphan')
+    materials: Mapped[list['Material']] = relationship('Material', back_populates='course', cascade='all, delete-orphan', passive_deletes=True)
 
 
 class Material(Base):
     __tablename__ = 'Materials'
+    __table_args__ = (
+        Index('uq_materials_course_counter', 'course_id', 'counter', unique=True),
+        Index('ix_materials_course_date_lesson', 'course_id', 'date_lesson'),
+        Index('ix_materials_date_lesson_course', 'date_lesson', 'course_id'),
+        Index('ix_materials_course_position', 'course_id', 'position', 'counter'),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String)
-    content: Mapped[str] = mapped_column(Text)
-    course_id: Mapped[int] = mapped_column(Integer, ForeignKey('Courses.id'))
+    # отложенная загрузка: select(Material) не читает текст, нужен - undefer(Material.content)
+    content: Mapped[str] = mapped_column(CompressedText, deferred=True)
+    course_id: Mapped[int] = mapped_column(Integer, ForeignKey('Courses.id', ondelete='CASCADE'))
     date_lesson: Mapped[datetime.date] = mapped_column(Date)
     counter:Mapped[int]=mapped_column(Integer, default=1)
+    # место в курсе, разреженный ключ: см. app/database/ordering.py. При равных позициях порядок по counter
+    position: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
 
     course: Mapped['Course'] = relationship('Course', back_populates='materials')
-    progress: Mapped['Progress'] = relationship('Progress', back_populates='material', cascade='all, delete-orphan')
+    progress: Mapped[list['Progress']] = relationship('Progress', back_populates='material', cascade='all, delete-orphan', passive_deletes=True)
 
 class Progress(Base):
     __tablename__ = 'Progress'
+    __table_args__ = (
+        Index('uq_progress_user_material', 'user_id', 'material_id', unique=True),
+        Index('ix_progress_material_id', 'material_id'),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('Users.id'))
-    material_id: Mapped[int] = mapped_column(Integer, ForeignKey('Materials.id'))
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('Users.id', ondelete='CASCADE'))
+    material_id: Mapped[int] = mapped_column(Integer, ForeignKey('Materials.id', ondelete='CASCADE'))
     completed: Mapped[bool] = mapped_column(Boolean)
 
     material: Mapped['Material'] = relationship('Material', back_populates='progress')
     user: Mapped['User'] = relationship('User', back_populates='progress')
 
+class MaterialStats(Base):
+    __tablename__ = 'MaterialStats'
+
+    # сколько студентов прошли материал, обновляется вместе с Progress
+    material_id: Mapped[int] = mapped_column(Integer, ForeignKey('Materials.id', ondelete='CASCADE'), primary_key=True)
+    course_id: Mapped[int] = mapped_column(Integer, ForeignKey('Courses.id', ondelete='CASCADE'), index=True)
+    completed: Mapped[int] = mapped_column(Integer, default=0)
+
+class CourseUserStats(Base):
+    __tablename__ = 'CourseUserStats'
+    __table_args__ = (
+        Index('ix_course_user_stats_user_id', 'user_id'),
+    )
+
+    # сколько материалов курса прошел студент
+    course_id: Mapped[int] = mapped_column(Integer, ForeignKey('Courses.id', ondelete='CASCADE'), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('Users.id', ondelete='CASCADE'), primary_key=True)
+    completed: Mapped[int] = mapped_column(Integer, default=0)
+
+class CourseCompletionStats(Base):
+    __tablename__ = 'CourseCompletionStats'
+
+    # распределение студентов курса по числу пройденных материалов
+    course_id: Mapped[int] = mapped_column(Integer, ForeignKey('Courses.id', ondelete='CASCADE'), primary_key=True)
+    completed: Mapped[int] = mapped_column(Integer, primary_key=True)
+    students: Mapped[int] = mapped_column(Integer, default=0)
+
+class RefreshToken(Base):
+    __tablename__ = 'RefreshTokens'
+
+    # только действующие refresh-токены, использованные и отозванные удаляются, истекшие - периодически.
+    # expires_at - UTC без часового пояса
+    jti: Mapped[str] = mapped_column(String(32), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('Users.id', ondelete='CASCADE'), index=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+
 
 
 async def create_tables():
-    async with engine.begin() as conn:
+    async with engine.connect() as conn:
+        sqlite = engine.dialect.name == 'sqlite'
+        if sqlite:
+            # миграции пересоздают таблицы, при включенных внешних ключах DROP TABLE удалил бы
+            # каскадом дочерние строки. Вне транзакции pragma переключается, внутри - нет
+            await conn.exec_driver_sql('PRAGMA foreign_keys=OFF')
         await conn.run_sync(Base.metadata.create_all)
-
-async def get_session():
+        await conn.run_sync(upgrade)
+        await conn.commit()
+        if sqlite:
+            await conn.exec_driver_sql('PRAGMA foreign_keys=ON')
+
+async def get_session(request: Request):
+    # в пакете /batch сессию выдает пакет (app/batch.py), закрывает ее тоже он
+    session = request.scope.get('batch_sessions', {}).get('write')
+    if session is not None:
+        yield session
+        return
     async with session_maker() as session:
         yield session
 
+async def get_read_session(request: Request):
+    session = request.scope.get('batch_sessions', {}).get('read')
+    if session is not None:
+        yield session
+        return
+    async with read_session_maker() as session:
+        yield session
+
+async def dispose_engines():
+    await engine.dispose()
+    await read_engine.dispose()
+    await batch_engine.dispose()
+
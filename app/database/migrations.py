@@ -0,0 +1,240 @@
+"""Версионные миграции схемы для уже существующих файлов БД.
+
+create_all создает только отсутствующие таблицы, поэтому индексы и ограничения,
+добавленные в модели позже, доезжают до старых баз через эти миграции.
+Номер примененной версии хранится в PRAGMA user_version.
+"""
+from sqlalchemy import Connection
+
+from app.database.compression import CONTENT_COMPRESS_MIN, compress_text, decompress_text
+from app.database.ordering import POSITION_STEP
+
+
+def _dedupe_materials(conn: Connection):
+    # материалы с одинаковым (course_id, counter) могли появиться при гонке в add_material,
+    # дубликатам выдаем следующие свободные номера
+    duplicates = conn.exec_driver_sql(
+        'SELECT id, course_id FROM Materials WHERE id NOT IN '
+        '(SELECT MIN(id) FROM Materials GROUP BY course_id, counter) ORDER BY id'
+    ).all()
+    for material_id, course_id in duplicates:
+        conn.exec_driver_sql(
+            'UPDATE Materials SET counter = (SELECT MAX(counter) + 1 FROM Materials WHERE course_id = ?) WHERE id = ?',
+            (course_id, material_id),
+        )
+
+
+def _migration_1_indexes(conn: Connection):
+    _dedupe_materials(conn)
+    conn.exec_driver_sql(
+        'DELETE FROM Progress WHERE id NOT IN (SELECT MIN(id) FROM Progress GROUP BY user_id, material_id)'
+    )
+
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_courses_owner_id ON Courses (owner_id)')
+    conn.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS uq_materials_course_counter ON Materials (course_id, counter)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_materials_course_date_lesson ON Materials (course_id, date_lesson)')
+    conn.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS uq_progress_user_material ON Progress (user_id, material_id)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_progress_material_id ON Progress (material_id)')
+
+
+def _migration_2_progress_stats(conn: Connection):
+    # таблицы статистики уже созданы create_all, заполняем их по существующим отметкам
+    conn.exec_driver_sql('DELETE FROM MaterialStats')
+    conn.exec_driver_sql('DELETE FROM CourseUserStats')
+    conn.exec_driver_sql('DELETE FROM CourseCompletionStats')
+    conn.exec_driver_sql(
+        'INSERT INTO MaterialStats (material_id, course_id, completed) '
+        'SELECT m.id, m.course_id, COUNT(*) FROM Progress p JOIN Materials m ON m.id = p.material_id GROUP BY m.id'
+    )
+    conn.exec_driver_sql(
+        'INSERT INTO CourseUserStats (course_id, user_id, completed) '
+        'SELECT m.course_id, p.user_id, COUNT(*) FROM Progress p JOIN Materials m ON m.id = p.material_id '
+        'GROUP BY m.course_id, p.user_id'
+    )
+    conn.exec_driver_sql(
+        'INSERT INTO CourseCompletionStats (course_id, completed, students) '
+        'SELECT course_id, completed, COUNT(*) FROM CourseUserStats GROUP BY course_id, completed'
+    )
+
+
+# схема таблиц с внешними ключами ON DELETE CASCADE на момент миграции 3
+_CASCADE_TABLES = {
+    'Courses': (
+        'CREATE TABLE "{name}" (id INTEGER NOT NULL, title VARCHAR NOT NULL, description TEXT NOT NULL, '
+        'owner_id INTEGER NOT NULL, PRIMARY KEY (id), '
+        'FOREIGN KEY(owner_id) REFERENCES "Users" (id) ON DELETE CASCADE)',
+        ['CREATE INDEX ix_courses_owner_id ON "Courses" (owner_id)'],
+    ),
+    'Materials': (
+        'CREATE TABLE "{name}" (id INTEGER NOT NULL, title VARCHAR NOT NULL, content TEXT NOT NULL, '
+        'course_id INTEGER NOT NULL, date_lesson DATE NOT NULL, counter INTEGER NOT NULL, PRIMARY KEY (id), '
+        'FOREIGN KEY(course_id) REFERENCES "Courses" (id) ON DELETE CASCADE)',
+        ['CREATE UNIQUE INDEX uq_materials_course_counter ON "Materials" (course_id, counter)',
+         'CREATE INDEX ix_materials_course_date_lesson ON "Materials" (course_id, date_lesson)'],
+    ),
+    'Progress': (
+        'CREATE TABLE "{name}" (id INTEGER NOT NULL, user_id INTEGER NOT NULL, material_id INTEGER NOT NULL, '
+        'completed BOOLEAN NOT NULL, PRIMARY KEY (id), '
+        'FOREIGN KEY(user_id) REFERENCES "Users" (id) ON DELETE CASCADE, '
+        'FOREIGN KEY(material_id) REFERENCES "Materials" (id) ON DELETE CASCADE)',
+        ['CREATE UNIQUE INDEX uq_progress_user_material ON "Progress" (user_id, material_id)',
+         'CREATE INDEX ix_progress_material_id ON "Progress" (material_id)'],
+    ),
+    'RefreshTokens': (
+        'CREATE TABLE "{name}" (jti VARCHAR(32) NOT NULL, user_id INTEGER NOT NULL, expires_at DATETIME NOT NULL, '
+        'PRIMARY KEY (jti), FOREIGN KEY(user_id) REFERENCES "Users" (id) ON DELETE CASCADE)',
+        ['CREATE INDEX "ix_RefreshTokens_user_id" ON "RefreshTokens" (user_id)'],
+    ),
+    'MaterialStats': (
+        'CREATE TABLE "{name}" (material_id INTEGER NOT NULL, course_id INTEGER NOT NULL, completed INTEGER NOT NULL, '
+        'PRIMARY KEY (material_id), '
+        'FOREIGN KEY(material_id) REFERENCES "Materials" (id) ON DELETE CASCADE, '
+        'FOREIGN KEY(course_id) REFERENCES "Courses" (id) ON DELETE CASCADE)',
+        ['CREATE INDEX "ix_MaterialStats_course_id" ON "MaterialStats" (course_id)'],
+    ),
+    'CourseUserStats': (
+        'CREATE TABLE "{name}" (course_id INTEGER NOT NULL, user_id INTEGER NOT NULL, completed INTEGER NOT NULL, '
+        'PRIMARY KEY (course_id, user_id), '
+        'FOREIGN KEY(course_id) REFERENCES "Courses" (id) ON DELETE CASCADE, '
+        'FOREIGN KEY(user_id) REFERENCES "Users" (id) ON DELETE CASCADE)',
+        ['CREATE INDEX ix_course_user_stats_user_id ON "CourseUserStats" (user_id)'],
+    ),
+    'CourseCompletionStats': (
+        'CREATE TABLE "{name}" (course_id INTEGER NOT NULL, completed INTEGER NOT NULL, students INTEGER NOT NULL, '
+        'PRIMARY KEY (course_id, completed), '
+        'FOREIGN KEY(course_id) REFERENCES "Courses" (id) ON DELETE CASCADE)',
+        [],
+    ),
+}
+
+_ORPHANS = [
+    'DELETE FROM Courses WHERE owner_id NOT IN (SELECT id FROM Users)',
+    'DELETE FROM Materials WHERE course_id NOT IN (SELECT id FROM Courses)',
+    'DELETE FROM Progress WHERE user_id NOT IN (SELECT id FROM Users) OR material_id NOT IN (SELECT id FROM Materials)',
+    'DELETE FROM RefreshTokens WHERE user_id NOT IN (SELECT id FROM Users)',
+]
+
+
+def _has_cascade(conn: Connection, table: str):
+    foreign_keys = conn.exec_driver_sql(f'PRAGMA foreign_key_list("{table}")').mappings().all()
+    return all(foreign_key['on_delete'] == 'CASCADE' for foreign_key in foreign_keys)
+
+
+def _migration_3_cascade_foreign_keys(conn: Connection):
+    # строки, оставшиеся от удалений без каскада, нарушили бы новые внешние ключи
+    for statement in _ORPHANS:
+        conn.exec_driver_sql(statement)
+    _migration_2_progress_stats(conn)
+
+    # SQLite не меняет внешние ключи у существующей таблицы - пересоздаем таблицу целиком.
+    # Работает только при PRAGMA foreign_keys=OFF, см. create_tables
+    for table, (create_sql, indexes) in _CASCADE_TABLES.items():
+        if _has_cascade(conn, table):
+            continue
+        columns = ', '.join(row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table}")').all())
+        conn.exec_driver_sql(create_sql.format(name=f'_new_{table}'))
+        conn.exec_driver_sql(f'INSERT INTO "_new_{table}" ({columns}) SELECT {columns} FROM "{table}"')
+        conn.exec_driver_sql(f'DROP TABLE "{table}"')
+        conn.exec_driver_sql(f'ALTER TABLE "_new_{table}" RENAME TO "{table}"')
+        for index_sql in indexes:
+            conn.exec_driver_sql(index_sql)
+
+
+def _migration_4_compress_content(conn: Connection):
+    # новые значения сжимает CompressedText, здесь - уже сохраненные длинные тексты.
+    # Место в файле освобождается только после VACUUM
+    last_id = 0
+    while True:
+        rows = conn.exec_driver_sql(
+            "SELECT id, content FROM Materials WHERE id > ? AND typeof(content) = 'text' "
+            'AND length(CAST(content AS BLOB)) >= ? ORDER BY id LIMIT 500',
+            (last_id, CONTENT_COMPRESS_MIN),
+        ).all()
+        if not rows:
+            break
+        conn.exec_driver_sql('UPDATE Materials SET content = ? WHERE id = ?',
+                             [(compress_text(content), material_id) for material_id, content in rows])
+        last_id = rows[-1][0]
+
+
+_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS CourseSearch USING fts5("
+    "title, body, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS MaterialSearch USING fts5("
+    "title, body, course_id UNINDEXED, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    'CREATE TRIGGER IF NOT EXISTS courses_search_insert AFTER INSERT ON Courses BEGIN '
+    'INSERT INTO CourseSearch (rowid, title, body) VALUES (new.id, new.title, new.description); END',
+    'CREATE TRIGGER IF NOT EXISTS courses_search_update AFTER UPDATE OF title, description ON Courses BEGIN '
+    'INSERT OR REPLACE INTO CourseSearch (rowid, title, body) VALUES (new.id, new.title, new.description); END',
+    'CREATE TRIGGER IF NOT EXISTS courses_search_delete AFTER DELETE ON Courses BEGIN '
+    'DELETE FROM CourseSearch WHERE rowid = old.id; END',
+    # вставку и изменение материалов индексирует app/search.py: content может быть сжат
+    'CREATE TRIGGER IF NOT EXISTS materials_search_delete AFTER DELETE ON Materials BEGIN '
+    'DELETE FROM MaterialSearch WHERE rowid = old.id; END',
+]
+
+
+def _migration_5_search(conn: Connection):
+    for statement in _SEARCH_DDL:
+        conn.exec_driver_sql(statement)
+
+    conn.exec_driver_sql('DELETE FROM CourseSearch')
+    conn.exec_driver_sql('INSERT INTO CourseSearch (rowid, title, body) SELECT id, title, description FROM Courses')
+    conn.exec_driver_sql('DELETE FROM MaterialSearch')
+    last_id = 0
+    while True:
+        rows = conn.exec_driver_sql(
+            'SELECT id, title, content, course_id FROM Materials WHERE id > ? ORDER BY id LIMIT 1000', (last_id,)
+        ).all()
+        if not rows:
+            break
+        conn.exec_driver_sql('INSERT INTO MaterialSearch (rowid, title, body, course_id) VALUES (?, ?, ?, ?)',
+                             [(material_id, title, decompress_text(content), course_id)
+                              for material_id, title, content, course_id in rows])
+        last_id = rows[-1][0]
+
+
+def _migration_6_upcoming_index(conn: Connection):
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_materials_date_lesson_course ON Materials (date_lesson, course_id)')
+
+
+def _migration_7_material_positions(conn: Connection):
+    # в новой базе колонку уже создал create_all. Начальный порядок - по номерам материалов
+    columns = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info("Materials")').all()}
+    if 'position' not in columns:
+        conn.exec_driver_sql('ALTER TABLE Materials ADD COLUMN position INTEGER NOT NULL DEFAULT 0')
+    conn.exec_driver_sql('UPDATE Materials SET position = counter * ?', (POSITION_STEP,))
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_materials_course_position ON Materials (course_id, position, counter)')
+
+
+def _migration_8_refresh_tokens_utc(conn: Connection):
+    # срок refresh-токенов раньше записывался в местном времени сервера
+    conn.exec_driver_sql("UPDATE RefreshTokens SET expires_at = datetime(expires_at, 'utc')")
+
+
+# (версия, функция) по возрастанию версий, новые миграции добавляются в конец
+MIGRATIONS = [
+    (1, _migration_1_indexes),
+    (2, _migration_2_progress_stats),
+    (3, _migration_3_cascade_foreign_keys),
+    (4, _migration_4_compress_content),
+    (5, _migration_5_search),
+    (6, _migration_6_upcoming_index),
+    (7, _migration_7_material_positions),
+    (8, _migration_8_refresh_tokens_utc),
+]
+
+
+def get_version(conn: Connection):
+    return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def upgrade(conn: Connection):
+    if conn.dialect.name != 'sqlite':
+        return
+
+    version = get_version(conn)
+    for target, migration in MIGRATIONS:
+        if target > version:
+            migration(conn)
+            conn.exec_driver_sql(f'PRAGMA user_version = {target}')
@@ -0,0 +1,28 @@
+"""Порядок материалов в курсе: разреженный ключ position.
+
+counter - постоянный номер материала в URL, position - его место в курсе.
+Позиции выдаются с шагом POSITION_STEP, поэтому перенос или вставка между
+соседями меняет одну строку: новая позиция - середина между позициями соседей.
+Когда между соседями не осталось свободных значений, позиции курса
+перенумеровываются заново с тем же шагом (crud.rebalance_positions).
+"""
+import os
+
+POSITION_STEP=int(os.getenv('MATERIAL_POSITION_STEP', 65536))
+
+
+def positions_between(prev_position: int | None, next_position: int | None, count: int=1):
+    """count позиций по возрастанию строго между соседями или None, если места не хватает.
+
+    None вместо позиции соседа - край курса: в начале и в конце места хватает всегда.
+    """
+    if prev_position is None and next_position is None:
+        return [POSITION_STEP*i for i in range(1, count+1)]
+    if prev_position is None:
+        return [next_position-POSITION_STEP*i for i in range(count, 0, -1)]
+    if next_position is None:
+        return [prev_position+POSITION_STEP*i for i in range(1, count+1)]
+    gap=(next_position-prev_position)//(count+1)
+    if gap<1:
+        return None
+    return [prev_position+gap*i for i in range(1, count+1)]
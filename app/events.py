@@ -0,0 +1,164 @@
+"""Лента изменений курса для Server-Sent Events (GET /events/{course_id}).
+
+Обработчики записи публикуют событие после commit, шина рассылает его подписчикам
+курса. Кадр SSE сериализуется один раз при публикации. У каждого подписчика своя
+очередь на EVENTS_QUEUE_SIZE кадров: кто не успевает ее разбирать, получает
+событие reset и отключается, чтобы не держать память и не тормозить остальных.
+
+id события - <запуск>-<номер>, номера растут по всему процессу. Последние
+EVENTS_HISTORY событий хранятся, и при переподключении с Last-Event-ID клиент
+получает пропущенные. Если пропущенных уже нет в истории или сервер перезапущен,
+приходит reset: состояние курса нужно перечитать целиком.
+
+События прогресса видны только владельцу курса и самому студенту. Шина работает
+внутри процесса: при нескольких процессах сервера подписчик видит изменения,
+сделанные только в своем процессе.
+"""
+import asyncio
+import itertools
+import json
+import os
+import secrets
+from collections import deque
+
+from app.batch import after_commit
+from app.metrics import register_collector
+
+EVENTS_QUEUE_SIZE=int(os.getenv('EVENTS_QUEUE_SIZE', 100))
+EVENTS_HISTORY=int(os.getenv('EVENTS_HISTORY', 10000))
+EVENTS_MAX_SUBSCRIBERS=int(os.getenv('EVENTS_MAX_SUBSCRIBERS', 10000))
+EVENTS_RETRY_AFTER=int(os.getenv('EVENTS_RETRY_AFTER', 5))
+EVENTS_HEARTBEAT=float(os.getenv('EVENTS_HEARTBEAT', 15))  # с, комментарий-пинг для прокси
+EVENTS_RETRY_MS=int(os.getenv('EVENTS_RETRY_MS', 3000))
+
+PING=b': ping\n\n'
+
+
+def _frame(event_id: str | None, event: str, data: dict):
+    payload=json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+    head=f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {event}\ndata: {payload}\n\n'.encode('utf-8')
+
+
+class Subscriber:
+    __slots__=('course_id', 'user_id', 'owner', 'queue')
+
+    def __init__(self, course_id: int, user_id: int, owner: bool):
+        self.course_id=course_id
+        self.user_id=user_id
+        self.owner=owner
+        # одно место сверх EVENTS_QUEUE_SIZE: после переполнения в очередь еще встают reset и конец потока
+        self.queue=asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE+1)
+
+    def full(self):
+        return self.queue.qsize()>=EVENTS_QUEUE_SIZE
+
+    def accepts(self, user_id: int | None):
+        # user_id события: None - событие для всех, иначе только для владельца и этого студента
+        return user_id is None or self.owner or user_id==self.user_id
+
+
+class EventBus:
+    def __init__(self, history: int):
+        self.boot=secrets.token_hex(4)
+        self._seq=itertools.count(1)
+        self._history=deque(maxlen=history)  # (номер, course_id, user_id, кадр)
+        self._evicted=0  # номер последнего события, вытесненного из истории
+        self._subscribers={}
+        self.published=0
+        self.dropped=0
+
+    @property
+    def subscriber_count(self):
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, course_id: int, event: str, data: dict, user_id: int | None=None):
+        # из атомарного пакета /batch событие уходит только после commit пакета
+        if after_commit(self.publish, course_id, event, data, user_id):
+            return
+        seq=next(self._seq)
+        frame=_frame(f'{self.boot}-{seq}', event, {'course_id': course_id, **data})
+        if len(self._history)==self._history.maxlen:
+            self._evicted=self._history[0][0]
+        self._history.append((seq, course_id, user_id, frame))
+        self.published+=1
+
+        for subscriber in list(self._subscribers.get(course_id, ())):
+            if not subscriber.accepts(user_id):
+                continue
+            if subscriber.full():
+                self.dropped+=1
+                self._close(subscriber)
+            else:
+                subscriber.queue.put_nowait(frame)
+
+    def _subscribe(self, course_id: int, user_id: int, owner: bool, last_event_id: str | None):
+        # подписка и кадры, которые нужно отдать до новых: пропущенные события или reset
+        subscriber=Subscriber(course_id, user_id, owner)
+        self._subscribers.setdefault(course_id, set()).add(subscriber)
+
+        if last_event_id is None:
+            return subscriber, []
+        boot, _, seq=last_event_id.rpartition('-')
+        if boot!=self.boot or not seq.isdigit() or int(seq)<self._evicted:
+            return subscriber, [_frame(None, 'reset', {'reason': 'history_lost'})]
+        last=int(seq)
+        return subscriber, [frame for event_seq, event_course_id, event_user_id, frame in self._history
+                            if event_seq>last and event_course_id==course_id and subscriber.accepts(event_user_id)]
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers=self._subscribers.get(subscriber.course_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.course_id]
+
+    def _close(self, subscriber: Subscriber):
+        # None в очереди - конец потока. Если места нет, недочитанные кадры отбрасываются,
+        # и клиент получает reset
+        self.unsubscribe(subscriber)
+        frames=[None]
+        if subscriber.full():
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+            frames=[_frame(None, 'reset', {'reason': 'slow_consumer'}), None]
+        for frame in frames:
+            subscriber.queue.put_nowait(frame)
+
+    def close_course(self, course_id: int):
+        if after_commit(self.close_course, course_id):
+            return
+        for subscriber in list(self._subscribers.get(course_id, ())):
+            self._close(subscriber)
+
+    def close_all(self):
+        for course_id in list(self._subscribers):
+            self.close_course(course_id)
+
+    async def stream(self, course_id: int, user_id: int, owner: bool, last_event_id: str | None):
+        # подписка внутри генератора: если ответ так и не начнется, подписчик не останется в шине
+        subscriber, backlog=self._subscribe(course_id, user_id, owner, last_event_id)
+        try:
+            yield f'retry: {EVENTS_RETRY_MS}\n\n'.encode()
+            for frame in backlog:
+                yield frame
+            while True:
+                try:
+                    frame=await asyncio.wait_for(subscriber.queue.get(), EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield PING
+                    continue
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            self.unsubscribe(subscriber)
+
+    def collect(self):
+        yield 'events_subscribers', 'gauge', 'Подписчики ленты изменений', (), [((), self.subscriber_count)]
+        yield 'events_published_total', 'counter', 'Опубликованные события', (), [((), self.published)]
+        yield 'events_dropped_subscribers_total', 'counter', 'Подписчики, отключенные за переполнение очереди', (), [((), self.dropped)]
+
+
+event_bus=EventBus(EVENTS_HISTORY)
+register_collector(event_bus.collect)
@@ -0,0 +1,40 @@
+"""Расписание занятий в формате iCalendar (RFC 5545) для подписки из календарей."""
+import datetime
+
+PRODID='-//courses//upcoming lessons//RU'
+
+
+def _escape(value: str):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+def _fold(line: str):
+    # строки длиннее 75 октетов переносятся, продолжение начинается с пробела
+    data=line.encode('utf-8')
+    if len(data)<=75:
+        return line
+    parts=[]
+    while data:
+        limit=75 if not parts else 74
+        cut=min(limit, len(data))
+        while cut<len(data) and (data[cut] & 0xC0)==0x80:  # не разрезаем символ UTF-8
+            cut-=1
+        parts.append(data[:cut].decode('utf-8'))
+        data=data[cut:]
+    return '\r\n '.join(parts)
+
+def render_calendar(lessons, name: str):
+    # lessons: строки с id, course_id, course_title, counter, title, date_lesson
+    stamp=datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines=['BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}', 'CALSCALE:GREGORIAN', f'X-WR-CALNAME:{_escape(name)}']
+    for lesson in lessons:
+        lines+=[
+            'BEGIN:VEVENT',
+            f'UID:material-{lesson.id}@courses',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART;VALUE=DATE:{lesson.date_lesson:%Y%m%d}',
+            f'DTEND;VALUE=DATE:{lesson.date_lesson + datetime.timedelta(days=1):%Y%m%d}',
+            f'SUMMARY:{_escape(f"{lesson.course_title}: {lesson.title}")}',
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(_fold(line) for line in lines)+'\r\n').encode('utf-8')
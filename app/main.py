@@ -1,34 +1,100 @@
+import datetime
+import os
 from contextlib import asynccontextmanager
+from typing import Literal
 
 import uvicorn
 
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, status, Query, Request, Response
 from fastapi.params import Depends
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy import select,  and_
+from sqlalchemy import select, delete
+from sqlalchemy.orm import undefer
 
+from pydantic import TypeAdapter, ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.crud import get_course_by_id, get_material_by_counter, get_max_counter_by_course, get_progress_user_material, \
-    get_user_by_id
-from app.models import MaterialCreate, MaterialResponse, ProgressResponse, CourseUpdate, MaterialUpdate
-from app.auth import get_password_hash, get_current_user, authentificate_user, create_token
+from app.crud import get_course_by_id, get_material_by_counter, get_courses_page, \
+    get_user_with_courses, insert_materials, mark_progress, get_material_ids_by_counters, count_course_progress, \
+    get_progress_dashboard, RequestLoader, get_loader, get_read_loader, get_materials, stream_materials, get_material_content, \
+    get_progress_course_ids, get_upcoming_lessons, move_material
+from app.models import MaterialCreate, MaterialResponse, ProgressResponse, CourseUpdate, MaterialUpdate, ProgressBatchCreate, \
+    ProgressBatchResponse, CourseProgressSummary, MaterialFunnelItem, CourseStudentsAnalytics, PurgeStatus, TokenResponse, \
+    CourseListResponse, MaterialsBatchResponse, CourseInfoResponse, ScheduleItem, MessageResponse, StatusResponse, \
+    UserCoursesResponse, SearchResponse, UpcomingLesson, material_projection, BatchRequest, BatchResponse, \
+    MaterialMove, WriteStatsResponse, ProfileReport
+from app.auth import hash_password, get_current_user, authentificate_user, create_token, hash_pool, invalidate_user, \
+    create_refresh_token, rotate_refresh_token, revoke_user_refresh_tokens, get_optional_user
 from app.crud import get_user_by_name
-from app.models import UserResponse, UserCreate, CourseCreate, CourseResponse
-from app.database.db import create_tables, User, get_session, Course, Material, Progress
+from app.models import UserResponse, UserCreate, CourseCreate, CourseResponse, RefreshRequest
+from app.database.db import create_tables, User, get_session, get_read_session, read_session_maker, dispose_engines, Course, Material
+from app.cache import response_cache, etag_matches
+from app.serialization import FastJSONResponse, json_response, adapter
+from app.search import index_materials, search
+from app.ical import render_calendar
+from app.coalescer import write_coalescer
+from app.batch import Operation, run_batch
+from app.events import event_bus, EVENTS_MAX_SUBSCRIBERS, EVENTS_RETRY_AFTER
+from app import metrics
+from app.profiling import ProfilingMiddleware, PROFILE_USERS, profiles
+from app.purge import purge_course, purge_user, get_job, cancel_jobs
+from app.analytics import forget_material, forget_user, get_material_funnel, get_completion_distribution, \
+    get_student_stats
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 
     await create_tables()
+    hash_pool.start()
+    write_coalescer.start()
     yield
+    event_bus.close_all()
+    await write_coalescer.stop()
+    await cancel_jobs()
+    hash_pool.shutdown()
+    await dispose_engines()
+
+
+app=FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+if metrics.METRICS:
+    app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(ProfilingMiddleware)
+
+MATERIALS_BATCH_LIMIT=int(os.getenv('MATERIALS_BATCH_LIMIT', 1000))
+UPCOMING_DEFAULT_DAYS=int(os.getenv('UPCOMING_DEFAULT_DAYS', 30))
+UPCOMING_MAX_DAYS=int(os.getenv('UPCOMING_MAX_DAYS', 366))
+UPCOMING_MAX_COURSES=int(os.getenv('UPCOMING_MAX_COURSES', 500))
+MATERIALS_STREAM_BATCH=int(os.getenv('MATERIALS_STREAM_BATCH', 1000))
+MATERIALS_LIST_LIMIT=int(os.getenv('MATERIALS_LIST_LIMIT', 10000))
+BATCH_MAX_OPERATIONS=int(os.getenv('BATCH_MAX_OPERATIONS', 50))
+MATERIAL_FIELDS=tuple(MaterialResponse.model_fields)
+material_list_adapter=TypeAdapter(list[MaterialCreate])
+
+
+def owned_course(loader_dependency):
+    async def dependency(course_id: int, cur_user: UserResponse=Depends(get_current_user), loader: RequestLoader=Depends(loader_dependency)):
+        course = await loader.course(course_id)
+        if not course:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
+        if cur_user.id != course.owner_id:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Это не ваш курс')
+        return course
+    return dependency
 
+# курс текущего пользователя по course_id из пути, для изменяющих и для читающих обработчиков
+get_owned_course=owned_course(get_loader)
+get_owned_course_read=owned_course(get_read_loader)
 
-app=FastAPI(lifespan=lifespan)
+async def get_owned_material(material_counter: int, course: Course=Depends(get_owned_course), loader: RequestLoader=Depends(get_loader)):
+    material = await loader.material(course.id, material_counter)
+    if not material:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал не найден')
+    return material
 
 
-@app.get('/')
+@app.get('/', response_model=str)
 async def root():
     return 'Сервис учета учебных курсов - Расписание, прогресс, материалы'
 
@@ -39,10 +105,11 @@ async def register(user_data: UserCreate, db:AsyncSession=Depends(get_session)):
     if db_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Уже зарегестрирован')
 
+    hashed_password=await hash_password(user_data.password)
     try:
         user=User(
         name=user_data.name,
-        hashed_password = get_password_hash(user_data.password))
+        hashed_password = hashed_password)
 
         db.add(user)
         await db.commit()
@@ -55,7 +122,7 @@ async def register(user_data: UserCreate, db:AsyncSession=Depends(get_session)):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post('/login', tags=['registration/auth'], summary='Получить токен', description='Post для получения jwt токена. Принимает логин(str) и пароль(str)')
+@app.post('/login', response_model=TokenResponse, tags=['registration/auth'], summary='Получить токен', description='Post для получения jwt токена. Принимает логин(str) и пароль(str)')
 async def login_for_token(form_data: OAuth2PasswordRequestForm=Depends(), session:AsyncSession=Depends(get_session)):
     user=await authentificate_user(session, form_data.username, form_data.password)
 
@@ -64,9 +131,17 @@ async def login_for_token(form_data: OAuth2PasswordRequestForm=Depends(), sessio
 
 
     token=create_token({'sub':user.name})
-    return {'access_token':token, 'token_type':'bearer', 'id':user.id, 'name':user.name}
+    refresh_token=await create_refresh_token(user, session)
+    return {'access_token':token, 'refresh_token':refresh_token, 'token_type':'bearer', 'id':user.id, 'name':user.name}
+
+@app.post('/refresh', response_model=TokenResponse, tags=['registration/auth'], summary='Обновить токен', description='Post для получения нового jwt токена по refresh токену без ввода пароля. Refresh токен одноразовый, в ответе выдается новый')
+async def refresh_token(data: RefreshRequest, session:AsyncSession=Depends(get_session)):
+    user, refresh_token=await rotate_refresh_token(data.refresh_token, session)
 
-@app.post('/add_course', tags=['course'], summary='Создать курс', description='Post для создания курса. Принимает название(str), описание(str). Требуется аутентификация')
+    token=create_token({'sub':user.name})
+    return {'access_token':token, 'refresh_token':refresh_token, 'token_type':'bearer', 'id':user.id, 'name':user.name}
+
+@app.post('/add_course', response_model=CourseResponse, tags=['course'], summary='Создать курс', description='Post для создания курса. Принимает название(str), описание(str). Требуется аутентификация')
 async def add_course(course_data: CourseCreate, cur_user: UserResponse=Depends(get_current_user), db:AsyncSession=Depends(get_session)):
     try:
         course=Course(
@@ -77,6 +152,7 @@ async def add_course(course_data: CourseCreate, cur_user: UserResponse=Depends(g
         db.add(course)
         await db.commit()
         await db.refresh(course)
+        response_cache.invalidate(course.id)
 
         res = CourseResponse.model_validate(course)
         res.owner_name=cur_user.name
@@ -85,90 +161,174 @@ async def add_course(course_data: CourseCreate, cur_user: UserResponse=Depends(g
         await db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get('/courses', tags=['course'], summary='Показать курсы', description='Get для получения всех курсов')
-async def show_courses(session:AsyncSession=Depends(get_session)):
-
-    query=select(Course)
-    result = await session.execute(query)
+@app.get('/courses', response_model=CourseListResponse, tags=['course'], summary='Показать курсы', description='Get для получения курсов постранично. Принимает cursor(int) - id последнего полученного курса и limit(int). В ответе next_cursor для следующей страницы')
+async def show_courses(cursor: int | None=Query(None, ge=0), limit: int=Query(50, ge=1, le=500), session:AsyncSession=Depends(get_read_session)):
 
-    courses_select = result.scalars().all()
-    CourseResponse_list=[]
-    for i in courses_select:
-        owner=await get_user_by_id(i.owner_id, session)
-        owner=owner.name
-        res = CourseResponse.model_validate(i)
-        res.owner_name = owner
+    rows, next_cursor = await get_courses_page(cursor, limit, session)
+    return json_response(CourseListResponse, {'courses': rows, 'next_cursor': next_cursor})
 
-        CourseResponse_list.append(res)
+def material_place(after: int | None=Query(None, ge=1), before: int | None=Query(None, ge=1)):
+    # место новых материалов: после материала after или перед материалом before, по умолчанию - в конце курса
+    if after is not None and before is not None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail='Укажите только after или только before')
+    return after, before
 
-    return CourseResponse_list
-
-@app.post('/courses/{course_id}', tags=['material'], summary='Создать материал', description='Post для создания материала(статьи). Принимает название(str), содержание(str). Требуется аутентификация')
-async def add_material(course_id:int, material_data: MaterialCreate, cur_user: UserResponse=Depends(get_current_user), db:AsyncSession=Depends(get_session)):
-    course=await get_course_by_id(course_id, db)
-
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-    if cur_user.id!=course.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Это не ваш курс')
+@app.post('/courses/{course_id}', response_model=MaterialResponse, tags=['material'], summary='Создать материал', description='Post для создания материала(статьи). Принимает название(str), содержание(str). Материал встает в конец курса, after или before (номера материалов) - вставить после или перед материалом. Требуется аутентификация')
+async def add_material(course_id:int, material_data: MaterialCreate, course: Course=Depends(get_owned_course), place: tuple=Depends(material_place), db:AsyncSession=Depends(get_session)):
+    try:
+        created = await write_coalescer.run(lambda session: insert_materials(course_id, [material_data], session, *place), db)
+        if created is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал, рядом с которым нужно вставить новый, не найден')
+        [(material_id, counter)] = created
+        response_cache.invalidate(course_id)
+        event_bus.publish(course_id, 'material.created', {'materials': [
+            {'id': material_id, 'counter': counter, 'title': material_data.title, 'date_lesson': material_data.date_lesson}],
+            'after': place[0], 'before': place[1]})
+
+        return MaterialResponse(id=material_id, course_id=course_id, counter=counter, **material_data.model_dump())
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
 
+async def read_materials_body(request: Request):
+    # JSON-массив целиком или NDJSON построчно, не держа в памяти исходный поток
     try:
-        counter = await get_max_counter_by_course(course_id, db)
-        if not counter:
-            counter=1
+        if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+            materials=[]
+            buffer=b''
+            async for chunk in request.stream():
+                buffer+=chunk
+                *lines, buffer=buffer.split(b'\n')
+                for line in lines:
+                    if line.strip():
+                        materials.append(MaterialCreate.model_validate_json(line))
+                if len(materials)>MATERIALS_BATCH_LIMIT:
+                    break
+            if buffer.strip():
+                materials.append(MaterialCreate.model_validate_json(buffer))
         else:
-            counter+=1
-
-        material=Material(
-            title=material_data.title,
-            content=material_data.content,
-            date_lesson=material_data.date_lesson,
-            course_id=course_id,
-            counter=counter
-        )
-
-        db.add(material)
-        await db.commit()
-        await db.refresh(material)
-
-        return MaterialResponse.model_validate(material)
-
+            materials=material_list_adapter.validate_json(await request.body())
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail=e.errors(include_url=False, include_context=False))
+
+    if len(materials)>MATERIALS_BATCH_LIMIT:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=f'Не больше {MATERIALS_BATCH_LIMIT} материалов за запрос')
+    if not materials:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail='Нет материалов для добавления')
+    return materials
+
+@app.post('/courses/{course_id}/materials', response_model=MaterialsBatchResponse, tags=['material'], summary='Создать материалы пачкой', description='Post для создания нескольких материалов одним запросом. Принимает JSON-массив материалов или NDJSON (Content-Type: application/x-ndjson), по одному материалу в строке. Номера выдаются подряд, все материалы добавляются в одной транзакции. Материалы встают в конец курса, after или before (номера материалов) - вставить после или перед материалом. Требуется аутентификация')
+async def add_materials_batch(course_id:int, request: Request, course: Course=Depends(get_owned_course), place: tuple=Depends(material_place), db:AsyncSession=Depends(get_session)):
+    materials=await read_materials_body(request)
+    try:
+        created=await write_coalescer.run(lambda session: insert_materials(course_id, materials, session, *place), db)
+        if created is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал, рядом с которым нужно вставить новые, не найден')
+        response_cache.invalidate(course_id)
+        event_bus.publish(course_id, 'material.created', {'materials': [
+            {'id': material_id, 'counter': counter, 'title': material.title, 'date_lesson': material.date_lesson}
+            for (material_id, counter), material in zip(created, materials)], 'after': place[0], 'before': place[1]})
+
+        return json_response(MaterialsBatchResponse, {'created': [{'id': material_id, 'counter': counter} for material_id, counter in created]})
+
+    except HTTPException:
+        raise
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get('/courses/{course_id}', tags=['course'], summary='Информация о курсе', description='Get для получения информации о курсе и материалов курса. Требуется аутентификация')
-async def course_info(course_id:int, session:AsyncSession=Depends(get_session)):
-    course = await get_course_by_id(course_id, session)
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-
-    response_info = {}
-    response_info['course_info'] = course
+@app.get('/courses/{course_id}', response_model=CourseInfoResponse, tags=['course'], summary='Информация о курсе', description='Get для получения информации о курсе и материалов курса в порядке курса. Требуется аутентификация')
+async def course_info(course_id:int, request: Request, session:AsyncSession=Depends(get_read_session)):
+    async def build():
+        course = await get_course_by_id(course_id, session)
+        if not course:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
 
-    query = select(Material).where(Material.course_id==course.id)
-    result = await session.execute(query)
-
-    materials_select = result.scalars().all()
-    response_info['materials']= materials_select
-    return response_info
-
-
-@app.get('/courses/{course_id}/{material_counter}', tags=['material'], summary='Информация о материале', description='Get для получения информации о материале по id курса и порядковому номеру материала. Требуется аутентификация')
-async def material_info(course_id:int, material_counter:int, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
-    course = await get_course_by_id(course_id, session)
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
+        query = select(Material).options(undefer(Material.content)).where(Material.course_id==course.id).order_by(Material.position, Material.counter)
+        result = await session.execute(query)
 
-    material=await get_material_by_counter(course_id, material_counter, session)
-    if not material:
+        return {'course_info': course, 'materials': result.scalars().all()}
+
+    return await response_cache.respond(request, f'course:{course_id}', course_id, CourseInfoResponse, build)
+
+
+@app.get('/courses/{course_id}/{material_counter}', response_model=MaterialResponse, tags=['material'], summary='Информация о материале', description='Get для получения информации о материале по id курса и порядковому номеру материала. Требуется аутентификация')
+async def material_info(course_id:int, material_counter:int, request: Request, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_read_session)):
+    async def build():
+        course = await get_course_by_id(course_id, session)
+        if not course:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
+
+        material=await get_material_by_counter(course_id, material_counter, session, with_content=True)
+        if not material:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал не найден')
+
+        return material
+
+    return await response_cache.respond(request, f'material:{course_id}:{material_counter}', course_id, MaterialResponse, build)
+
+def parse_range(header: str | None, size: int):
+    # один диапазон bytes=start-end, bytes=start- или bytes=-suffix. None - отдать целиком,
+    # несколько диапазонов и неразборчивый заголовок тоже отдаются целиком (RFC 9110)
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[len('bytes='):].strip().partition('-')
+    if not sep or not (start or end) or not all(part.isdigit() for part in (start, end) if part):
+        return None
+    if not start:
+        length = int(end)
+        if length == 0:
+            raise HTTPException(status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE, detail='Диапазон вне содержания',
+                                headers={'Content-Range': f'bytes */{size}'})
+        return max(size - length, 0), size - 1
+    first = int(start)
+    last = min(int(end), size - 1) if end else size - 1
+    if first >= size or first > last:
+        raise HTTPException(status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE, detail='Диапазон вне содержания',
+                            headers={'Content-Range': f'bytes */{size}'})
+    return first, last
+
+@app.get('/courses/{course_id}/{material_counter}/content', response_class=Response, responses={status.HTTP_200_OK: {'content': {'text/plain': {}}}, status.HTTP_206_PARTIAL_CONTENT: {'content': {'text/plain': {}}}}, tags=['material'], summary='Содержание материала', description='Get для получения содержания материала текстом. Поддерживает заголовок Range (bytes=start-end) для загрузки частями. Требуется аутентификация')
+async def material_content(course_id:int, material_counter:int, request: Request, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_read_session)):
+    etag = response_cache.etag(course_id)
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+    if etag_matches(etag, request.headers.get('if-none-match')):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    content = await get_material_content(course_id, material_counter, session)
+    if content is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал не найден')
 
+    body = content.encode('utf-8')
+    byte_range = parse_range(request.headers.get('range'), len(body))
+    # If-Range с устаревшим ETag - диапазон не применяется, отдаем новую версию целиком
+    if byte_range is None or request.headers.get('if-range', etag) != etag:
+        return Response(content=body, media_type='text/plain; charset=utf-8', headers=headers)
 
-    return MaterialResponse.model_validate(material)
+    first, last = byte_range
+    headers['Content-Range'] = f'bytes {first}-{last}/{len(body)}'
+    return Response(content=body[first:last + 1], status_code=status.HTTP_206_PARTIAL_CONTENT,
+                    media_type='text/plain; charset=utf-8', headers=headers)
 
-@app.post('/courses/{course_id}/{material_counter}', tags=['progress'], summary='Отметить прогресс', description='Post для отметки прогресса для данного пользователя и конкретного материала. Требуется аутентификация')
+@app.post('/courses/{course_id}/{material_counter}', response_model=ProgressResponse, tags=['progress'], summary='Отметить прогресс', description='Post для отметки прогресса для данного пользователя и конкретного материала. Требуется аутентификация')
 async def set_progress(course_id:int, material_counter:int, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
+    try:
+        created=await write_coalescer.run(lambda db: mark_progress(cur_user.id, course_id, [material_counter], db), session)
+    except HTTPException:
+        raise
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if created:
+        [(progress_id, material_id)]=created
+        event_bus.publish(course_id, 'progress.recorded', {'user_id': cur_user.id, 'counters': [material_counter]}, user_id=cur_user.id)
+        return ProgressResponse(id=progress_id, user_id=cur_user.id, material_id=material_id)
+
+    # ничего не вставлено: либо нет курса/материала, либо прогресс уже отмечен
     course = await get_course_by_id(course_id, session)
     if not course:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
@@ -177,52 +337,52 @@ async def set_progress(course_id:int, material_counter:int, cur_user: UserRespon
     if not material:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал не найден')
 
-    progress_for_check=await get_progress_user_material(cur_user.id, material.id, session)
-    if progress_for_check:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Прогресс для этого пользователя и материала уже отмечен')
-    try:
-        progress=Progress(
-            user_id=cur_user.id,
-            material_id=material.id,
-            completed=True
-        )
-
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Прогресс для этого пользователя и материала уже отмечен')
 
-        session.add(progress)
-        await session.commit()
-        await session.refresh(progress)
+@app.post('/progress/{course_id}', response_model=ProgressBatchResponse, tags=['progress'], summary='Отметить прогресс пачкой', description='Post для отметки прогресса сразу по нескольким материалам курса. Принимает список порядковых номеров материалов (counters). В ответе номера новых отметок, уже отмеченных и несуществующих материалов. Требуется аутентификация')
+async def set_progress_batch(course_id:int, progress_data: ProgressBatchCreate, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
+    counters=list(dict.fromkeys(progress_data.counters))
 
-        return ProgressResponse.model_validate(progress)
+    async def record(db: AsyncSession):
+        return await mark_progress(cur_user.id, course_id, counters, db), await get_material_ids_by_counters(course_id, counters, db)
 
+    try:
+        created, material_ids=await write_coalescer.run(record, session)
+    except HTTPException:
+        raise
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
+    if not material_ids:
+        course = await get_course_by_id(course_id, session)
+        if not course:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
 
-@app.put('/courses/{course_id}', tags=['course'], summary='Изменить курс', description='Put для Изменения курса. Можно изменить название(str), описание(str). Требуется аутентификация')
-async def update_course(course_id:int, course_data: CourseUpdate, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
-    course=await get_course_by_id(course_id, session)
+    created_ids={material_id for _, material_id in created}
+    recorded=[counter for counter in counters if material_ids.get(counter) in created_ids]
+    if recorded:
+        event_bus.publish(course_id, 'progress.recorded', {'user_id': cur_user.id, 'counters': recorded}, user_id=cur_user.id)
+    return ProgressBatchResponse(
+        recorded=recorded,
+        already_recorded=[counter for counter in counters if counter in material_ids and material_ids[counter] not in created_ids],
+        not_found=[counter for counter in counters if counter not in material_ids],
+    )
 
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-    if cur_user.id != course.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Это не ваш курс')
 
+@app.put('/courses/{course_id}', response_model=CourseResponse, tags=['course'], summary='Изменить курс', description='Put для Изменения курса. Можно изменить название(str), описание(str). Требуется аутентификация')
+async def update_course(course_id:int, course_data: CourseUpdate, course: Course=Depends(get_owned_course), cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
     try:
-        query = select(Course).where(Course.id == course_id)
-        result = await session.execute(query)
-        course = result.scalar_one_or_none()
         for key, value in course_data:
             if value is not None:
                 setattr(course, key, value)
 
         await session.commit()
-        await session.refresh(course)
+        response_cache.invalidate(course_id)
+        event_bus.publish(course_id, 'course.updated', {'title': course.title, 'description': course.description})
         course=CourseResponse.model_validate(course)
-        owner = await get_user_by_id(course.owner_id, session)
-        owner = owner.name
-        course.owner_name = owner
-
+        # курс принадлежит текущему пользователю, отдельно владельца не ищем
+        course.owner_name = cur_user.name
 
         return course
     except Exception as e:
@@ -230,165 +390,311 @@ async def update_course(course_id:int, course_data: CourseUpdate, cur_user: User
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.get('/materials', tags=['material'], summary='Материалы', description='Get для получения информации о существующих материалах')
-async def show_materials(session:AsyncSession=Depends(get_session)):
-
-    query=select(Material)
-    result = await session.execute(query)
-
-    materials_select = result.scalars().all()
-    MaterialResponse_list=[]
-    for i in materials_select:
-        MaterialResponse_list.append(MaterialResponse.model_validate(i))
-
-    return MaterialResponse_list
-
-@app.delete('/courses/{course_id}', tags=['course'], summary='Удалить курс', description='Delete для удаления курса. Удаляет материалы и отметки прогресса. Требуется аутентификация')
-async def delete_course(course_id:int, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
-    course=await get_course_by_id(course_id, session)
-
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-    if cur_user.id != course.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Это не ваш курс')
-
+def material_fields(fields: str | None=Query(None, description='Поля через запятую, например id,title,date_lesson. По умолчанию все')):
+    if fields is None:
+        return MATERIAL_FIELDS
+    requested={name.strip() for name in fields.split(',') if name.strip()}
+    unknown=requested-set(MATERIAL_FIELDS)
+    if unknown or not requested:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail=f'Допустимые поля: {", ".join(MATERIAL_FIELDS)}')
+    # порядок полей как в MaterialResponse, чтобы одна проекция давала один ключ кеша
+    return tuple(name for name in MATERIAL_FIELDS if name in requested)
+
+async def ndjson_materials(fields: tuple[str, ...], course_id: int | None, date_from: datetime.date | None, date_to: datetime.date | None):
+    # своя сессия: поток отдается уже после выхода из обработчика
+    item_adapter=adapter(material_projection(fields))
+    async with read_session_maker() as session:
+        async for rows in stream_materials(fields, course_id, date_from, date_to, MATERIALS_STREAM_BATCH, session):
+            yield b''.join(item_adapter.dump_json(item_adapter.validate_python(row, from_attributes=True))+b'\n' for row in rows)
+
+@app.get('/materials', response_model=list[MaterialResponse], responses={status.HTTP_200_OK: {'content': {'application/x-ndjson': {}}}}, tags=['material'], summary='Материалы', description='Get для получения информации о существующих материалах. Можно отфильтровать по курсу (course_id) и дате занятия (date_from, date_to) и выбрать поля (fields). С заголовком Accept: application/x-ndjson материалы отдаются потоком, по одному в строке. В JSON - не больше MATERIALS_LIST_LIMIT материалов, иначе 413')
+async def show_materials(request: Request, course_id: int | None=Query(None), date_from: datetime.date | None=Query(None), date_to: datetime.date | None=Query(None),
+                         fields: tuple[str, ...]=Depends(material_fields), session:AsyncSession=Depends(get_read_session)):
+    if request.headers.get('accept', '').startswith('application/x-ndjson'):
+        return StreamingResponse(ndjson_materials(fields, course_id, date_from, date_to), media_type='application/x-ndjson')
+
+    async def build():
+        # список в JSON собирается в памяти целиком, поэтому ограничен: больше - только потоком
+        rows = await get_materials(fields, course_id, date_from, date_to, session, limit=MATERIALS_LIST_LIMIT+1)
+        if len(rows) > MATERIALS_LIST_LIMIT:
+            raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                                detail=f'Больше {MATERIALS_LIST_LIMIT} материалов: уточните фильтры или запросите Accept: application/x-ndjson')
+        return rows
+
+    if course_id is None or date_from is not None or date_to is not None:
+        # произвольные выборки по всем курсам и окна дат не кешируются: вариантов ключа без счета,
+        # а размер кеша ограничен числом записей, а не байтами
+        return json_response(list[material_projection(fields)], await build())
+
+    key=f'materials:{course_id}:{",".join(fields)}'
+    return await response_cache.respond(request, key, course_id, list[material_projection(fields)], build)
+
+def close_course_events(course_id: int):
+    event_bus.publish(course_id, 'course.deleted', {})
+    event_bus.close_course(course_id)
+
+@app.delete('/courses/{course_id}', response_model=StatusResponse, responses={status.HTTP_202_ACCEPTED: {'model': PurgeStatus}}, tags=['course'], summary='Удалить курс', description='Delete для удаления курса. Удаляет материалы и отметки прогресса. Требуется аутентификация')
+async def delete_course(course_id:int, course: Course=Depends(get_owned_course), session:AsyncSession=Depends(get_session)):
     try:
-        query = select(Course).where(Course.id == course_id)
-        result = await session.execute(query)
-        course = result.scalar_one_or_none()
-        await session.delete(course)
+        job = await purge_course(course_id, session)
+        if job:
+            close_course_events(course_id)
+            return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job.info())
 
         await session.commit()
+        response_cache.invalidate(course_id)
+        close_course_events(course_id)
 
         return {'status': 'Успешное удаление'}
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.delete('/courses/{course_id}/{material_counter}', tags=['material'], summary='Удалить материал', description='Delete для удаления материала. Удаляет отметки прогресса. Требуется аутентификация')
-async def delete_material(course_id:int, material_counter: int, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
-    course=await get_course_by_id(course_id, session)
-
-
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-    material = await get_material_by_counter(course_id, material_counter, session)
-    if not material:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал не найден')
-    if cur_user.id != course.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Это не ваш курс')
-
+@app.delete('/courses/{course_id}/{material_counter}', response_model=StatusResponse, tags=['material'], summary='Удалить материал', description='Delete для удаления материала. Удаляет отметки прогресса. Требуется аутентификация')
+async def delete_material(course_id:int, material_counter: int, material: Material=Depends(get_owned_material), session:AsyncSession=Depends(get_session)):
     try:
-        query = select(Material).where(Material.id == material.id)
-        result = await session.execute(query)
-        material = result.scalar_one_or_none()
-        await session.delete(material)
+        await forget_material(course_id, material.id, session)
+        await session.execute(delete(Material).where(Material.id == material.id))
 
         await session.commit()
+        response_cache.invalidate(course_id)
+        event_bus.publish(course_id, 'material.deleted', {'id': material.id, 'counter': material_counter})
 
         return {'status': 'Успешное удаление'}
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.delete('/user/{user_id}', tags=['user'], summary='Удалить пользователя', description='Delete для удаления пользователя. Удаляет курсы, созданные пользователем, их материалы и отметки прогресса. Требуется аутентификация')
+@app.delete('/user/{user_id}', response_model=StatusResponse, responses={status.HTTP_202_ACCEPTED: {'model': PurgeStatus}}, tags=['user'], summary='Удалить пользователя', description='Delete для удаления пользователя. Удаляет курсы, созданные пользователем, их материалы и отметки прогресса. Требуется аутентификация')
 async def delete_user(user_id:int, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
 
     if cur_user.id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Вы не можете удалить чужой аккаунт')
 
     try:
-        query = select(User).where(User.id == user_id)
-        result = await session.execute(query)
-        user = result.scalar_one_or_none()
-        await session.delete(user)
+        result = await session.execute(select(Course.id).where(Course.owner_id == user_id))
+        course_ids = result.scalars().all()
+        await forget_user(user_id, session)
+        await revoke_user_refresh_tokens(user_id, session)
+        job = await purge_user(user_id, course_ids, session)
 
         await session.commit()
+        invalidate_user(user_id)
+        for course_id in course_ids:
+            close_course_events(course_id)
+        if job:
+            return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job.info())
+        response_cache.invalidate(*course_ids)
 
         return {'status': 'Успешное удаление'}
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get('/progress/{course_id}', tags=['progress'], summary='Прогресс по курсу', description='Get для просмотра прогресса пользователя по курсу. Требуется аутентификация')
-async def course_progress(course_id:int,  cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
-
-    course = await get_course_by_id(course_id, session)
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-
-    query = select(Material.id).where(Material.course_id == course_id)
-    result = await session.execute(query)
-    material_ids = result.scalars().all()
-
-    if len(material_ids) == 0:
-        return {'Message': 'В данном курсе пока нет занятий'}
-
-    query = select(Progress).where(and_(Progress.material_id.in_(material_ids), Progress.user_id == cur_user.id))
-    result = await session.execute(query)
-    progress_select = result.scalars().all()
-
-    return {'Message': f'Пройдено {len(progress_select)} из {len(material_ids)} занятий'}
+@app.get('/progress/{course_id}', response_model=MessageResponse, tags=['progress'], summary='Прогресс по курсу', description='Get для просмотра прогресса пользователя по курсу. Требуется аутентификация')
+async def course_progress(course_id:int,  cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_read_session)):
 
-@app.get('/schedule/{course_id}', tags=['course'], summary='Расписание курса', description='Get для получения расписания занятий курса с названием соответствующих материалов. Требуется аутентификация')
-async def course_schedule(course_id:int, session:AsyncSession=Depends(get_session)):
+    completed, total = await count_course_progress(cur_user.id, course_id, session)
 
-    course = await get_course_by_id(course_id, session)
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-
-    query = select(Material.title, Material.date_lesson).where(Material.course_id == course_id).order_by(Material.date_lesson)
-    result = await session.execute(query)
-    materials = result.all()
-
-    if len(materials) == 0:
+    if total == 0:
+        course = await get_course_by_id(course_id, session)
+        if not course:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
         return {'Message': 'В данном курсе пока нет занятий'}
 
-    return [{'title':title, 'date_lesson':date_lesson} for title, date_lesson in materials]
+    return {'Message': f'Пройдено {completed} из {total} занятий'}
 
-@app.put('/courses/{course_id}/{material_counter}', tags=['material'], summary='Изменить материал', description='Post для изменения материала курса. Можно изменить название, содержание, дату проведения занятия. Требуется аутентификация')
-async def update_material(course_id:int, material_counter:int, material_data: MaterialUpdate, cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_session)):
-    course=await get_course_by_id(course_id, session)
+@app.get('/progress', response_model=list[CourseProgressSummary], tags=['progress'], summary='Прогресс по всем курсам', description='Get для получения прогресса пользователя по всем курсам, где у него есть отметки: сколько занятий пройдено и сколько всего. Требуется аутентификация')
+async def progress_dashboard(cur_user: UserResponse=Depends(get_current_user), session:AsyncSession=Depends(get_read_session)):
+    rows = await get_progress_dashboard(cur_user.id, session)
+    return json_response(list[CourseProgressSummary], rows)
 
-    if not course:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
-    material = await get_material_by_counter(course_id, material_counter, session)
-    if not material:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал не найден')
-    if cur_user.id != course.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Это не ваш курс')
+@app.get('/schedule/{course_id}', response_model=list[ScheduleItem] | MessageResponse, tags=['course'], summary='Расписание курса', description='Get для получения расписания занятий курса с названием соответствующих материалов в порядке курса. Требуется аутентификация')
+async def course_schedule(course_id:int, request: Request, session:AsyncSession=Depends(get_read_session)):
+    async def build():
+        course = await get_course_by_id(course_id, session)
+        if not course:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
 
+        query = select(Material.title, Material.date_lesson).where(Material.course_id == course_id).order_by(Material.position, Material.counter)
+        result = await session.execute(query)
+        materials = result.all()
+
+        if len(materials) == 0:
+            return {'Message': 'В данном курсе пока нет занятий'}
+
+        return materials
+
+    return await response_cache.respond(request, f'schedule:{course_id}', course_id, list[ScheduleItem] | MessageResponse, build)
+
+async def upcoming_window(course_id: list[int] | None=Query(None, description='id курсов. Без них - курсы, где у пользователя есть отметки прогресса, нужен токен'),
+                          date_from: datetime.date | None=Query(None, description='По умолчанию сегодня'),
+                          date_to: datetime.date | None=Query(None, description=f'По умолчанию date_from + {UPCOMING_DEFAULT_DAYS} дней'),
+                          cur_user: UserResponse | None=Depends(get_optional_user), session:AsyncSession=Depends(get_read_session)):
+    date_from = date_from or datetime.date.today()
+    date_to = date_to or date_from + datetime.timedelta(days=UPCOMING_DEFAULT_DAYS)
+    if date_to < date_from or (date_to - date_from).days > UPCOMING_MAX_DAYS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail=f'Окно дат должно быть не длиннее {UPCOMING_MAX_DAYS} дней')
+
+    if course_id:
+        course_ids = sorted(set(course_id))
+    elif cur_user is not None:
+        course_ids = sorted(await get_progress_course_ids(cur_user.id, session))
+    else:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Не авторизован', headers={'WWW-Authenticate': 'Bearer'})
+    if len(course_ids) > UPCOMING_MAX_COURSES:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail=f'Не больше {UPCOMING_MAX_COURSES} курсов за запрос')
+    return tuple(course_ids), date_from, date_to
+
+def upcoming_scope(course_ids: tuple[int, ...], date_from: datetime.date, date_to: datetime.date):
+    # даты входят в scope, чтобы ETag сменился вместе с окном (окно по умолчанию сдвигается каждый день)
+    return (date_from.isoformat(), date_to.isoformat(), *course_ids)
+
+@app.get('/upcoming', response_model=list[UpcomingLesson], tags=['course'], summary='Ближайшие занятия', description='Get для получения занятий всех выбранных курсов в окне дат, по порядку дат. Курсы - список course_id, без него - курсы, где у пользователя есть отметки прогресса (нужен токен)')
+async def upcoming_lessons(request: Request, window: tuple=Depends(upcoming_window), session:AsyncSession=Depends(get_read_session)):
+    course_ids, date_from, date_to = window
+
+    async def build():
+        return await get_upcoming_lessons(list(course_ids), date_from, date_to, session)
+
+    key = f'upcoming:{date_from}:{date_to}:{",".join(map(str, course_ids))}'
+    return await response_cache.respond(request, key, upcoming_scope(*window), list[UpcomingLesson], build)
+
+@app.get('/upcoming.ics', response_class=Response, responses={status.HTTP_200_OK: {'content': {'text/calendar': {}}}}, tags=['course'], summary='Календарь занятий', description='Get для получения тех же занятий, что и /upcoming, в формате iCalendar для подписки из календаря. Отдается с ETag, на If-None-Match с тем же значением - 304')
+async def upcoming_calendar(request: Request, window: tuple=Depends(upcoming_window), session:AsyncSession=Depends(get_read_session)):
+    course_ids, date_from, date_to = window
+
+    async def build():
+        lessons = await get_upcoming_lessons(list(course_ids), date_from, date_to, session)
+        return render_calendar(lessons, 'Занятия')
+
+    key = f'upcoming.ics:{date_from}:{date_to}:{",".join(map(str, course_ids))}'
+    return await response_cache.respond(request, key, upcoming_scope(*window), None, build, media_type='text/calendar; charset=utf-8')
+
+@app.post('/courses/{course_id}/{material_counter}/move', response_model=StatusResponse, tags=['material'], summary='Переместить материал', description='Post для изменения порядка материалов курса: материал ставится после материала after или перед материалом before (номера материалов). Номер материала и его адрес не меняются. Требуется аутентификация')
+async def move_material_in_course(course_id:int, material_counter:int, data: MaterialMove, material: Material=Depends(get_owned_material), session:AsyncSession=Depends(get_session)):
+    if (data.after is None) == (data.before is None):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail='Укажите after или before')
+    if material_counter in (data.after, data.before):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail='Материал нельзя переместить относительно самого себя')
+    try:
+        neighbours = await write_coalescer.run(lambda db: move_material(course_id, material.id, data.after, data.before, db), session)
+        if neighbours is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Материал, рядом с которым нужно поставить этот, не найден')
+        response_cache.invalidate(course_id)
+        event_bus.publish(course_id, 'material.moved', {'id': material.id, 'counter': material_counter, 'after': neighbours[0], 'before': neighbours[1]})
+
+        return {'status': 'Материал перемещен'}
+    except HTTPException:
+        raise
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
 
+@app.put('/courses/{course_id}/{material_counter}', response_model=MaterialResponse, tags=['material'], summary='Изменить материал', description='Post для изменения материала курса. Можно изменить название, содержание, дату проведения занятия. Требуется аутентификация')
+async def update_material(course_id:int, material_counter:int, material_data: MaterialUpdate, material: Material=Depends(get_owned_material), session:AsyncSession=Depends(get_session)):
     try:
-        query = select(Material).where(and_(Material.course_id == course_id, Material.counter==material_counter))
-        result = await session.execute(query)
-        material = result.scalar_one_or_none()
         for key, value in material_data:
             if value is not None:
                 setattr(material, key, value)
 
+        if material_data.content is None:
+            # content отложен и при поиске материала не загружался
+            await session.refresh(material, attribute_names=['content'])
+        if material_data.title is not None or material_data.content is not None:
+            await index_materials([{'id': material.id, 'course_id': material.course_id, 'title': material.title,
+                                    'content': material.content}], session)
+
         await session.commit()
-        await session.refresh(material)
+        response_cache.invalidate(course_id)
+        event_bus.publish(course_id, 'material.updated', {'id': material.id, 'counter': material.counter, 'title': material.title,
+                                                          'date_lesson': material.date_lesson, 'content_changed': material_data.content is not None})
 
         return MaterialResponse.model_validate(material)
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get('/user/{user_id}', tags=['user'], summary='Информация о пользователе', description='Get для получения курсов, созданных пользователем')
-async def user_courses(user_id: int, session:AsyncSession=Depends(get_session)):
+@app.get('/user/{user_id}', response_model=UserCoursesResponse, tags=['user'], summary='Информация о пользователе', description='Get для получения курсов, созданных пользователем')
+async def user_courses(user_id: int, session:AsyncSession=Depends(get_read_session)):
 
-    query = select(User).where(User.id == user_id)
-    result = await session.execute(query)
-    user=result.scalar_one_or_none()
+    user=await get_user_with_courses(user_id, session)
     if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Пользователь не найден')
-    query=select(Course).where(Course.owner_id==user_id)
-    result = await session.execute(query)
-    courses = result.scalars().all()
 
 
-    return {'username': user.name, 'user_id':user.id, 'courses':courses}
+    return json_response(UserCoursesResponse, {'username': user.name, 'user_id':user.id, 'courses':user.courses})
+
+@app.get('/analytics/{course_id}/materials', response_model=list[MaterialFunnelItem], tags=['analytics'], summary='Воронка прохождения курса', description='Get для получения числа студентов, прошедших каждый материал курса, по порядку материалов. Только для владельца курса. Требуется аутентификация')
+async def course_funnel(course_id: int, course: Course=Depends(get_owned_course_read), session:AsyncSession=Depends(get_read_session)):
+
+    rows = await get_material_funnel(course_id, session)
+    return json_response(list[MaterialFunnelItem], rows)
+
+@app.get('/analytics/{course_id}/students', response_model=CourseStudentsAnalytics, tags=['analytics'], summary='Статистика студентов курса', description='Get для получения распределения студентов по числу пройденных материалов и постраничного списка студентов (cursor - id последнего полученного студента, limit). Только для владельца курса. Требуется аутентификация')
+async def course_students(course_id: int, cursor: int | None=Query(None, ge=0), limit: int=Query(50, ge=1, le=500), course: Course=Depends(get_owned_course_read), session:AsyncSession=Depends(get_read_session)):
+
+    distribution = await get_completion_distribution(course_id, session)
+    rows, next_cursor = await get_student_stats(course_id, cursor, limit, session)
+    return json_response(CourseStudentsAnalytics, {'distribution': distribution, 'students': rows, 'next_cursor': next_cursor})
+
+@app.get('/search', response_model=SearchResponse, tags=['search'], summary='Поиск', description='Get для полнотекстового поиска по названиям и описаниям курсов и по названиям и содержанию материалов. Результаты по релевантности (bm25), совпадения в title и snippet выделены <b></b>, остальной текст экранирован для HTML. truncated - при SEARCH_RANK_WINDOW ранжировалась только часть совпадений. kind - all, course или material, course_id - искать только в материалах курса. Постранично: offset и limit, в ответе next_offset')
+async def search_catalog(q: str=Query(..., min_length=1, max_length=200), kind: Literal['all', 'course', 'material']=Query('all'), course_id: int | None=Query(None),
+                         limit: int=Query(20, ge=1, le=100), offset: int=Query(0, ge=0, le=1000), session:AsyncSession=Depends(get_read_session)):
+    hits, next_offset, truncated = await search(q, kind, course_id, limit, offset, session)
+    return json_response(SearchResponse, {'results': hits, 'next_offset': next_offset, 'truncated': truncated})
+
+@app.get('/events/{course_id}', response_class=StreamingResponse, responses={status.HTTP_200_OK: {'content': {'text/event-stream': {}}}}, tags=['course'], summary='Лента изменений курса', description='Get для подписки на изменения курса в формате Server-Sent Events вместо периодического опроса: material.created, material.updated, material.moved, material.deleted, course.updated, course.deleted, progress.recorded (отметки видны владельцу курса и самому студенту). Заголовок Last-Event-ID - получить пропущенные события после переподключения. Событие reset - пропущенные события недоступны, состояние курса нужно перечитать. Требуется аутентификация')
+async def course_events(course_id: int, request: Request, cur_user: UserResponse=Depends(get_current_user), session: AsyncSession=Depends(get_read_session)):
+    course = await get_course_by_id(course_id, session)
+    if not course:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Курс с таким id не найден')
+    if event_bus.subscriber_count >= EVENTS_MAX_SUBSCRIBERS:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Сервер перегружен, повторите позже',
+                            headers={'Retry-After': str(EVENTS_RETRY_AFTER)})
+    # сессия закрывалась бы только после конца потока и все это время держала бы соединение из пула
+    await session.close()
+
+    stream = event_bus.stream(course_id, cur_user.id, course.owner_id == cur_user.id, request.headers.get('last-event-id'))
+    return StreamingResponse(stream, media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.post('/batch', response_model=BatchResponse, tags=['batch'], summary='Пакет запросов', description='Post для выполнения нескольких запросов к API за один вызов, например открыть страницу курса: /courses/{id}, /schedule/{id}, /progress/{id}. operations - список {method, path, body}, в ответе results - {status, body} каждой операции в том же порядке. Подряд идущие GET выполняются параллельно. atomic=true - все операции по порядку в одной транзакции: после первой ошибки остальные не выполняются (status 424), изменения откатываются, committed=false. /batch и /events в пакете недоступны. Требуется аутентификация')
+async def batch(data: BatchRequest, request: Request, cur_user: UserResponse=Depends(get_current_user)):
+    if len(data.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=f'Не больше {BATCH_MAX_OPERATIONS} операций в пакете')
+    operations = [Operation(operation.method, operation.path, operation.body) for operation in data.operations]
+    results, committed = await run_batch(request.app, request.scope, operations, data.atomic)
+    # тела операций уже в JSON и вставляются как есть
+    body = b'{"results":[' + b','.join(results) + b'],"committed":' + (b'null' if committed is None else b'true' if committed else b'false') + b'}'
+    return Response(content=body, media_type='application/json')
+
+@app.get('/stats/writes', response_model=WriteStatsResponse, tags=['stats'], summary='Статистика группового commit', description='Get для получения статистики объединения записей (WRITE_COALESCE): число пачек и записей, распределение размеров пачек, ожидание в очереди и время commit')
+async def write_stats():
+    return write_coalescer.stats()
+
+@app.get('/metrics', response_class=Response, responses={status.HTTP_200_OK: {'content': {'text/plain': {}}}}, tags=['stats'], summary='Метрики', description='Get для получения метрик в текстовом формате Prometheus: число и длительность запросов по маршрутам, запросы в работе, число и время SQL-запросов, медленные запросы, ожидание соединения в пуле, время bcrypt, очередь группового commit')
+async def get_metrics():
+    if not metrics.METRICS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Метрики отключены (METRICS=0)')
+    return Response(content=metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.get('/profiles/{profile_id}', response_model=ProfileReport, responses={status.HTTP_200_OK: {'content': {'text/plain': {}}}}, tags=['stats'], summary='Профиль запроса', description='Get для получения профиля запроса, выполненного с заголовком X-Profile (id - из заголовка ответа X-Profile-Id): SQL-запросы с временем и выборка стеков CPU. format=folded - стеки в формате flamegraph. Только для пользователей из PROFILE_USERS. Требуется аутентификация')
+async def get_profile(profile_id: str, format: Literal['json', 'folded']='json', cur_user: UserResponse=Depends(get_current_user)):
+    if cur_user.name not in PROFILE_USERS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Профилирование недоступно')
+    report = profiles.get(profile_id)
+    if report is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Профиль не найден')
+    if format == 'folded':
+        return Response(content='\n'.join(report['cpu']['folded'])+'\n', media_type='text/plain; charset=utf-8')
+    return report
+
+@app.get('/purge/{job_id}', response_model=PurgeStatus, tags=['user'], summary='Статус удаления', description='Get для получения статуса фонового удаления большого курса или пользователя')
+async def purge_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Задача удаления не найдена')
+    return job.info()
 
 
 if __name__ == '__main__':
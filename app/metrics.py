@@ -0,0 +1,232 @@
+"""Метрики сервиса в текстовом формате Prometheus (GET /metrics).
+
+MetricsMiddleware считает запросы и их длительность по шаблону маршрута
+(/courses/{course_id}, а не /courses/17), события движков SQLAlchemy - число SQL-
+запросов и время в БД, отнесенные к текущему запросу через contextvar. Запросы
+дольше SLOW_QUERY_MS пишутся в лог вместе с маршрутом. TimedQueuePool замеряет
+ожидание свободного соединения, HashPool - время bcrypt.
+
+Все значения - счетчики в памяти процесса, обновляются в event loop без блокировок.
+Значения, которые дешевле прочитать, чем вести (запросы в работе, занятые соединения,
+очереди), собираются при чтении /metrics функциями из register_collector.
+"""
+import bisect
+import contextvars
+import logging
+import math
+import os
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+METRICS=os.getenv('METRICS', '1')=='1'
+SLOW_QUERY_MS=float(os.getenv('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG_CHARS=500
+
+LATENCY_BUCKETS=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# маршрут для SQL вне запросов (фоновые задачи, писатель WRITE_COALESCE) и для 404
+BACKGROUND_ROUTE='(background)'
+UNMATCHED_ROUTE='(unmatched)'
+
+logger=logging.getLogger(__name__)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped=(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{'+','.join(f'{name}="{value}"' for name, value in zip(names, escaped))+'}'
+
+def _format_value(value):
+    if value==math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]=()):
+        self.name=name
+        self.help=help
+        self.labels=labels
+        self.values={}
+
+    def inc(self, value: float=1, *labels):
+        self.values[labels]=self.values.get(labels, 0)+value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in self.values.items():
+            yield f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]=(), buckets: tuple[float, ...]=LATENCY_BUCKETS):
+        self.name=name
+        self.help=help
+        self.labels=labels
+        self.buckets=buckets
+        self.series={}  # значения меток -> [число в каждой корзине..., сверх последней, сумма]
+
+    def observe(self, value: float, *labels):
+        series=self.series.get(labels)
+        if series is None:
+            series=self.series[labels]=[0]*(len(self.buckets)+1)+[0]
+        series[bisect.bisect_left(self.buckets, value)]+=1
+        series[-1]+=value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        names=self.labels+('le',)
+        for labels, series in self.series.items():
+            cumulative=0
+            for bound, count in zip(self.buckets+(math.inf,), series):
+                cumulative+=count
+                yield f'{self.name}_bucket{_format_labels(names, labels+(_format_value(bound),))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(series[-1])}'
+            yield f'{self.name}_count{_format_labels(self.labels, labels)} {cumulative}'
+
+
+requests_total=Counter('http_requests_total', 'Запросы по маршруту и коду ответа', ('method', 'route', 'status'))
+request_duration=Histogram('http_request_duration_seconds', 'Время запроса до конца ответа', ('method', 'route'))
+request_queries=Histogram('http_request_db_queries', 'SQL-запросов на один запрос к API', ('method', 'route'), QUERY_COUNT_BUCKETS)
+db_queries_total=Counter('db_queries_total', 'SQL-запросы по движку и маршруту', ('engine', 'route'))
+db_query_seconds_total=Counter('db_query_seconds_total', 'Время выполнения SQL по движку и маршруту', ('engine', 'route'))
+db_query_duration=Histogram('db_query_duration_seconds', 'Время одного SQL-запроса', ('engine',))
+db_slow_queries_total=Counter('db_slow_queries_total', f'SQL-запросы дольше SLOW_QUERY_MS ({SLOW_QUERY_MS:g} мс)', ('engine', 'route'))
+db_pool_wait=Histogram('db_pool_wait_seconds', 'Получение соединения из пула: ожидание свободного или открытие нового', ('engine',))
+bcrypt_duration=Histogram('bcrypt_duration_seconds', 'Время bcrypt в пуле хеширования, с ожиданием очереди', ('operation',))
+
+METRICS_LIST=[requests_total, request_duration, request_queries, db_queries_total, db_query_seconds_total, db_query_duration,
+              db_slow_queries_total, db_pool_wait, bcrypt_duration]
+_collectors=[]
+
+
+def register_collector(collect):
+    """collect() -> [(имя, тип, описание, метки, [(значения меток, значение), ...])], вызывается при чтении /metrics."""
+    _collectors.append(collect)
+
+
+class RequestState:
+    __slots__=('scope', 'queries')
+
+    def __init__(self, scope):
+        self.scope=scope
+        self.queries=0
+
+    def route(self):
+        # роутер FastAPI кладет найденный маршрут в scope
+        route=self.scope.get('route')
+        return route.path if route is not None else UNMATCHED_ROUTE
+
+
+_current_request=contextvars.ContextVar('metrics_request', default=None)
+_active_requests=set()
+
+
+class MetricsMiddleware:
+    # чистое ASGI, без BaseHTTPMiddleware: не создает лишних задач и не буферизует потоковые ответы
+    def __init__(self, app):
+        self.app=app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type']!='http':
+            await self.app(scope, receive, send)
+            return
+
+        state=RequestState(scope)
+        token=_current_request.set(state)
+        _active_requests.add(state)
+        status_code=500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type']=='http.response.start':
+                status_code=message['status']
+            await send(message)
+
+        started=time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed=time.perf_counter()-started
+            _active_requests.discard(state)
+            _current_request.reset(token)
+            method, route=scope['method'], state.route()
+            requests_total.inc(1, method, route, str(status_code))
+            request_duration.observe(elapsed, method, route)
+            request_queries.observe(state.queries, method, route)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # имя движка - pool_logging_name, оно сохраняется и при пересоздании пула
+    def _do_get(self):
+        started=time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter()-started, self.logging_name)
+
+
+_pools={}
+
+
+def instrument_engine(engine, name: str):
+    sync_engine=engine.sync_engine
+    _pools[name]=sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def query_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def query_finished(conn, cursor, statement, parameters, context, executemany):
+        elapsed=time.perf_counter()-conn.info['metrics_query_started'].pop()
+        state=_current_request.get()
+        route=BACKGROUND_ROUTE
+        if state is not None:
+            state.queries+=1
+            route=state.route()
+        db_queries_total.inc(1, name, route)
+        db_query_seconds_total.inc(elapsed, name, route)
+        db_query_duration.observe(elapsed, name)
+        if elapsed*1000>=SLOW_QUERY_MS:
+            db_slow_queries_total.inc(1, name, route)
+            logger.warning('медленный SQL %.1f мс, %s, движок %s: %s', elapsed*1000, route, name,
+                           ' '.join(statement.split())[:SLOW_QUERY_LOG_CHARS])
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def query_failed(exception_context):
+        connection=exception_context.connection
+        if connection is not None and connection.info.get('metrics_query_started'):
+            connection.info['metrics_query_started'].pop()
+
+
+def _builtin_samples():
+    in_flight={}
+    for state in list(_active_requests):
+        labels=(state.scope['method'], state.route())
+        in_flight[labels]=in_flight.get(labels, 0)+1
+    yield 'http_requests_in_flight', 'gauge', 'Запросы в работе', ('method', 'route'), list(in_flight.items())
+
+    pools=[(name, sync_engine.pool) for name, sync_engine in _pools.items()]
+    yield 'db_pool_checked_out', 'gauge', 'Выданные соединения пула', ('engine',), \
+        [((name,), pool.checkedout()) for name, pool in pools if hasattr(pool, 'checkedout')]
+    yield 'db_pool_size', 'gauge', 'Постоянных соединений в пуле', ('engine',), \
+        [((name,), pool.size()) for name, pool in pools if hasattr(pool, 'size')]
+
+
+def render():
+    lines=[]
+    for metric in METRICS_LIST:
+        lines.extend(metric.render())
+    for collect in [_builtin_samples, *_collectors]:
+        for name, kind, help, label_names, samples in collect():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{_format_labels(label_names, labels)} {_format_value(value)}' for labels, value in samples)
+    return ('\n'.join(lines)+'\n').encode('utf-8')
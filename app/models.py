@@ -1,6 +1,8 @@
 import datetime
+import functools
+from typing import Any, Literal
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, create_model
 
 
 class UserCreate(BaseModel):
@@ -16,6 +18,18 @@ class UserResponse(BaseModel):
         from_attributes=True
 
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+class TokenResponse(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str
+    id: int
+    name: str
+
+
 class CourseCreate(BaseModel):
     title: str = Field(..., min_length=1, max_length=100)
     description: str | None = Field(None, max_length=300)
@@ -26,18 +40,31 @@ class CourseUpdate(BaseModel):
     description: str | None = Field(None, min_length=1, max_length=300)
 
 
-class CourseResponse(BaseModel):
+class CourseBrief(BaseModel):
     id: int
     title: str = Field(..., min_length=1, max_length=100)
     description: str | None = Field(None, max_length=300)
     owner_id: int
-    owner_name: str | None=Field(None)
-
 
     class Config:
         from_attributes=True
 
 
+class CourseResponse(CourseBrief):
+    owner_name: str | None=Field(None)
+
+
+class CourseListResponse(BaseModel):
+    courses: list[CourseResponse]
+    next_cursor: int | None = None
+
+
+class UserCoursesResponse(BaseModel):
+    username: str
+    user_id: int
+    courses: list[CourseBrief]
+
+
 class MaterialCreate(BaseModel):
     title: str = Field(..., min_length=1, max_length=100)
     content: str = Field(..., min_length=1)
@@ -48,6 +75,10 @@ class MaterialUpdate(BaseModel):
     content: str | None = Field(None, min_length=1)
     date_lesson: datetime.date | None =Field(None)
 
+class MaterialMove(BaseModel):
+    after: int | None = Field(None, ge=1)
+    before: int | None = Field(None, ge=1)
+
 class MaterialResponse(BaseModel):
     title: str = Field(..., min_length=1, max_length=100)
     content: str = Field(..., min_length=1)
@@ -60,13 +91,210 @@ class MaterialResponse(BaseModel):
         from_attributes=True
 
 
+@functools.cache
+def material_projection(fields: tuple[str, ...]):
+    # модель с частью полей MaterialResponse, например без content для списков
+    return create_model('MaterialProjection', __config__=ConfigDict(from_attributes=True),
+                        **{name: (MaterialResponse.model_fields[name].annotation, ...) for name in fields})
+
+
+class MaterialCreated(BaseModel):
+    id: int
+    counter: int
+
+
+class MaterialsBatchResponse(BaseModel):
+    created: list[MaterialCreated]
+
+
+class CourseInfoResponse(BaseModel):
+    course_info: CourseBrief
+    materials: list[MaterialResponse]
+
+
+class ScheduleItem(BaseModel):
+    title: str
+    date_lesson: datetime.date
+
+    class Config:
+        from_attributes=True
+
+
+class UpcomingLesson(BaseModel):
+    course_id: int
+    course_title: str
+    counter: int
+    title: str
+    date_lesson: datetime.date
+
+    class Config:
+        from_attributes=True
+
+
+class MessageResponse(BaseModel):
+    Message: str
+
+
+class StatusResponse(BaseModel):
+    status: str
+
+
 class ProgressCreate(BaseModel):
     completed: bool = False
 
+class ProgressBatchCreate(BaseModel):
+    counters: list[int] = Field(..., min_length=1, max_length=1000)
+
 class ProgressResponse(BaseModel):
     id: int
     user_id: int
     material_id: int
 
     class Config:
-        from_attributes=True
\ No newline at end of file
+        from_attributes=True
+
+
+class ProgressBatchResponse(BaseModel):
+    recorded: list[int]
+    already_recorded: list[int]
+    not_found: list[int]
+
+
+class CourseProgressSummary(BaseModel):
+    course_id: int
+    title: str
+    completed: int
+    total: int
+
+    class Config:
+        from_attributes=True
+
+
+class MaterialFunnelItem(BaseModel):
+    counter: int
+    title: str
+    completed: int
+
+    class Config:
+        from_attributes=True
+
+
+class CompletionBucket(BaseModel):
+    completed: int
+    students: int
+
+    class Config:
+        from_attributes=True
+
+
+class StudentStats(BaseModel):
+    user_id: int
+    name: str
+    completed: int
+
+    class Config:
+        from_attributes=True
+
+
+class CourseStudentsAnalytics(BaseModel):
+    distribution: list[CompletionBucket]
+    students: list[StudentStats]
+    next_cursor: int | None = None
+
+
+class PurgeStatus(BaseModel):
+    job_id: str
+    kind: str
+    target_id: int
+    status: str
+    deleted_rows: int
+    error: str | None = None
+
+
+class SearchHit(BaseModel):
+    kind: str
+    course_id: int | None = None
+    counter: int | None = None
+    title: str
+    snippet: str
+    rank: float
+
+
+class SearchResponse(BaseModel):
+    results: list[SearchHit]
+    next_offset: int | None = None
+    truncated: bool = False
+
+
+class WriteStatsResponse(BaseModel):
+    enabled: bool
+    queue_depth: int
+    batches: int
+    items: int
+    errors: int
+    avg_batch_size: float
+    max_batch_size: int
+    batch_sizes: dict[str, int]
+    avg_queue_wait_ms: float
+    max_queue_wait_ms: float
+    avg_commit_ms: float
+
+
+class ProfileStatement(BaseModel):
+    sql: str
+    ms: float
+
+
+class ProfileSql(BaseModel):
+    count: int
+    total_ms: float
+    statements: list[ProfileStatement]
+
+
+class ProfileFunction(BaseModel):
+    function: str
+    self: int
+    total: int
+
+
+class ProfileCpu(BaseModel):
+    interval_ms: float
+    samples: int
+    top_self: list[ProfileFunction]
+    top_total: list[ProfileFunction]
+    folded: list[str]
+
+
+class ProfileReport(BaseModel):
+    id: str
+    user: str
+    method: str
+    path: str
+    query_string: str
+    route: str | None = None
+    status: int
+    created: str
+    duration_ms: float
+    sql: ProfileSql
+    cpu: ProfileCpu
+
+
+class BatchOperation(BaseModel):
+    method: Literal['GET', 'POST', 'PUT', 'DELETE']
+    path: str = Field(..., pattern=r'^/', description='Путь с query-параметрами, например /courses/1?limit=10')
+    body: Any = None
+
+
+class BatchRequest(BaseModel):
+    operations: list[BatchOperation] = Field(..., min_length=1)
+    atomic: bool = False
+
+
+class BatchResult(BaseModel):
+    status: int
+    body: Any = None
+
+
+class BatchResponse(BaseModel):
+    results: list[BatchResult]
+    committed: bool | None = None
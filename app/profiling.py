@@ -0,0 +1,169 @@
+"""Профиль отдельного запроса по заголовку X-Profile.
+
+Запрос с заголовком X-Profile и токеном пользователя из PROFILE_USERS выполняется
+под профилировщиком: отдельный поток каждые PROFILE_INTERVAL_MS мс снимает стек
+потока event loop, а querylog записывает все SQL-запросы с временем. Отчет
+хранится в памяти (PROFILE_KEEP последних), в ответ добавляются заголовки
+X-Profile-Id и Server-Timing, сам отчет - GET /profiles/{id}.
+
+Стек снимается со всего потока event loop: если параллельно выполняются другие
+запросы, их работа тоже попадет в выборку. Время, когда loop ждет ввода-вывода
+(в том числе SQLite в потоке aiosqlite), видно как ожидание в select. Профиль
+заканчивается с началом ответа, тело потокового ответа в него не входит.
+Без заголовка запрос проходит мимо, не читая токен.
+"""
+import datetime
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+
+from app.auth import verify_token
+from app.cache import TTLCache
+from app.querylog import record_queries
+
+PROFILE_USERS=frozenset(name.strip() for name in os.getenv('PROFILE_USERS', '').split(',') if name.strip())
+PROFILE_INTERVAL_MS=float(os.getenv('PROFILE_INTERVAL_MS', 1))
+PROFILE_KEEP=int(os.getenv('PROFILE_KEEP', 100))
+PROFILE_TTL=float(os.getenv('PROFILE_TTL', 3600))
+PROFILE_MAX_DEPTH=128
+PROFILE_TOP=30
+
+profiles=TTLCache(PROFILE_KEEP, PROFILE_TTL)
+
+
+def _frame_name(code):
+    filename=code.co_filename
+    for prefix in sys.path:
+        if prefix and filename.startswith(prefix):
+            filename=filename[len(prefix):].lstrip(os.sep)
+            break
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id=thread_id
+        self.interval=interval
+        self.stacks=Counter()
+        self._stop=threading.Event()
+        self._thread=threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        names={}
+        while not self._stop.wait(self.interval):
+            frame=sys._current_frames().get(self.thread_id)
+            stack=[]
+            while frame is not None and len(stack)<PROFILE_MAX_DEPTH:
+                code=frame.f_code
+                name=names.get(code)
+                if name is None:
+                    name=names[code]=_frame_name(code)
+                stack.append(name)
+                frame=frame.f_back
+            if stack:
+                stack.reverse()
+                self.stacks[tuple(stack)]+=1
+
+    def summary(self):
+        self_samples, total_samples=Counter(), Counter()
+        for stack, count in self.stacks.items():
+            self_samples[stack[-1]]+=count
+            for name in set(stack):
+                total_samples[name]+=count
+        return {
+            'interval_ms': self.interval*1000,
+            'samples': sum(self.stacks.values()),
+            'top_self': [{'function': name, 'self': count, 'total': total_samples[name]}
+                         for name, count in self_samples.most_common(PROFILE_TOP)],
+            'top_total': [{'function': name, 'self': self_samples[name], 'total': count}
+                          for name, count in total_samples.most_common(PROFILE_TOP)],
+            # формат flamegraph.pl и speedscope: кадры через ;, число выборок
+            'folded': [f'{";".join(stack)} {count}' for stack, count in self.stacks.most_common()],
+        }
+
+
+async def _principal(authorization: bytes | None):
+    if not authorization:
+        return None
+    scheme, _, token=authorization.decode('latin-1').partition(' ')
+    if scheme.lower()!='bearer':
+        return None
+    payload=await verify_token(token)
+    if payload is None or payload.get('type')=='refresh':
+        return None
+    return payload.get('sub')
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app=app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type']!='http' or not PROFILE_USERS:
+            await self.app(scope, receive, send)
+            return
+        headers=dict(scope['headers'])
+        if b'x-profile' not in headers:
+            await self.app(scope, receive, send)
+            return
+        user=await _principal(headers.get(b'authorization'))
+        if user not in PROFILE_USERS:
+            await self.app(scope, receive, send)
+            return
+
+        profile_id=secrets.token_hex(8)
+        sampler=StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS/1000)
+        created=datetime.datetime.now(datetime.timezone.utc)
+        report=None
+
+        def finish(status_code, log):
+            nonlocal report
+            elapsed=time.perf_counter()-started
+            sampler.stop()
+            route=scope.get('route')
+            report={
+                'id': profile_id,
+                'user': user,
+                'method': scope['method'],
+                'path': scope['path'],
+                'query_string': scope['query_string'].decode('latin-1'),
+                'route': route.path if route is not None else None,
+                'status': status_code,
+                'created': created.isoformat(timespec='milliseconds'),
+                'duration_ms': round(elapsed*1000, 3),
+                'sql': {
+                    'count': log.count,
+                    'total_ms': round(log.seconds*1000, 3),
+                    'statements': [{'sql': statement, 'ms': round(seconds*1000, 3)} for statement, seconds in log.statements],
+                },
+                'cpu': sampler.summary(),
+            }
+            profiles.set(profile_id, report)
+            return report
+
+        with record_queries() as log:
+            async def send_with_profile(message):
+                if message['type']=='http.response.start' and report is None:
+                    finished=finish(message['status'], log)
+                    timing=f'db;dur={finished["sql"]["total_ms"]};desc="{finished["sql"]["count"]} SQL", app;dur={finished["duration_ms"]}'
+                    message={**message, 'headers': [*message.get('headers', []), (b'x-profile-id', profile_id.encode()),
+                                                    (b'server-timing', timing.encode())]}
+                await send(message)
+
+            started=time.perf_counter()
+            sampler.start()
+            try:
+                await self.app(scope, receive, send_with_profile)
+            finally:
+                if report is None:
+                    finish(500, log)
@@ -0,0 +1,138 @@
+"""Удаление курсов и пользователей одним DELETE с каскадом на уровне БД.
+
+Если удаление затрагивает больше PURGE_SYNC_LIMIT отметок прогресса, оно уходит в
+фоновую задачу: строки удаляются пачками по PURGE_BATCH_SIZE, каждая пачка в своей
+транзакции, так что между пачками блокировка записи SQLite освобождается.
+"""
+import asyncio
+import os
+import secrets
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache import response_cache
+from app.database.db import session_maker, User, Course, Material, Progress, MaterialStats, CourseUserStats
+
+PURGE_SYNC_LIMIT=int(os.getenv('PURGE_SYNC_LIMIT', 10000))
+PURGE_BATCH_SIZE=int(os.getenv('PURGE_BATCH_SIZE', 5000))
+PURGE_PAUSE=float(os.getenv('PURGE_PAUSE', 0.05))  # секунды между пачками
+
+
+class PurgeJob:
+    def __init__(self, kind: str, target_id: int, batches: list, final, course_ids: list[int]):
+        self.id=secrets.token_urlsafe(12)
+        self.kind=kind
+        self.target_id=target_id
+        self.status='running'
+        self.deleted_rows=0
+        self.error=None
+        self.task=None
+        self._batches=batches
+        self._final=final
+        self._course_ids=course_ids
+
+    async def run(self):
+        try:
+            for make_query in self._batches:
+                while True:
+                    async with session_maker() as session:
+                        result=await session.execute(make_query())
+                        await session.commit()
+                    self.deleted_rows+=result.rowcount
+                    if result.rowcount<PURGE_BATCH_SIZE:
+                        break
+                    await asyncio.sleep(PURGE_PAUSE)
+
+            async with session_maker() as session:
+                await session.execute(self._final)
+                await session.commit()
+            self.status='done'
+        except asyncio.CancelledError:
+            self.status='cancelled'
+            raise
+        except Exception as e:
+            self.status='failed'
+            self.error=str(e)
+        finally:
+            running.pop((self.kind, self.target_id), None)
+            response_cache.invalidate(*self._course_ids)
+
+    def info(self):
+        return {'job_id': self.id, 'kind': self.kind, 'target_id': self.target_id, 'status': self.status,
+                'deleted_rows': self.deleted_rows, 'error': self.error}
+
+
+jobs: dict[str, PurgeJob]={}
+# (вид, id) -> выполняющаяся задача, проверяется на каждом запросе с токеном
+running: dict[tuple[str, int], PurgeJob]={}
+
+def _start(job: PurgeJob):
+    for old in [old for old in jobs.values() if old.status!='running'][:-100]:
+        del jobs[old.id]
+    jobs[job.id]=job
+    running[(job.kind, job.target_id)]=job
+    job.task=asyncio.create_task(job.run())
+    return job
+
+def find_running(kind: str, target_id: int):
+    return running.get((kind, target_id))
+
+def get_job(job_id: str):
+    return jobs.get(job_id)
+
+async def cancel_jobs():
+    tasks=[job.task for job in jobs.values() if job.status=='running']
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _batch(model, ids):
+    # DELETE ... WHERE id IN (SELECT id ... LIMIT n): сборка SQLite не поддерживает LIMIT в самом DELETE
+    return lambda: delete(model).where(model.id.in_(ids.limit(PURGE_BATCH_SIZE)))
+
+async def purge_course(course_id: int, session: AsyncSession):
+    """Удаляет курс с материалами, прогрессом и статистикой.
+
+    Возвращает PurgeJob, если удаление ушло в фон, иначе None - тогда commit делает вызывающий.
+    """
+    running=find_running('course', course_id)
+    if running:
+        return running
+
+    progress_rows=await session.scalar(
+        select(func.coalesce(func.sum(MaterialStats.completed), 0)).where(MaterialStats.course_id==course_id))
+    if progress_rows<=PURGE_SYNC_LIMIT:
+        await session.execute(delete(Course).where(Course.id==course_id))
+        return None
+
+    course_materials=select(Material.id).where(Material.course_id==course_id)
+    batches=[
+        _batch(Progress, select(Progress.id).where(Progress.material_id.in_(course_materials))),
+        _batch(Material, course_materials),
+    ]
+    return _start(PurgeJob('course', course_id, batches, delete(Course).where(Course.id==course_id), [course_id]))
+
+async def purge_user(user_id: int, course_ids: list[int], session: AsyncSession):
+    """Удаляет пользователя, его курсы и весь связанный прогресс.
+
+    Возвращает PurgeJob, если удаление ушло в фон, иначе None - тогда commit делает вызывающий.
+    Пока задача идет, строка пользователя еще есть, а статистика уже уменьшена (forget_user),
+    поэтому вход, обновление токена и запросы от его имени отклоняются (app/auth.py).
+    """
+    own_progress=await session.scalar(
+        select(func.coalesce(func.sum(CourseUserStats.completed), 0)).where(CourseUserStats.user_id==user_id))
+    courses_progress=await session.scalar(
+        select(func.coalesce(func.sum(MaterialStats.completed), 0)).where(MaterialStats.course_id.in_(course_ids)))
+    if own_progress+courses_progress<=PURGE_SYNC_LIMIT:
+        await session.execute(delete(User).where(User.id==user_id))
+        return None
+
+    courses_materials=select(Material.id).where(Material.course_id.in_(course_ids))
+    batches=[
+        _batch(Progress, select(Progress.id).where(Progress.user_id==user_id)),
+        _batch(Progress, select(Progress.id).where(Progress.material_id.in_(courses_materials))),
+        _batch(Material, courses_materials),
+    ]
+    return _start(PurgeJob('user', user_id, batches, delete(User).where(User.id==user_id), course_ids))
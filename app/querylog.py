@@ -0,0 +1,87 @@
+"""Запись SQL-запросов текущего контекста: для профилирования запросов и проверки бюджета.
+
+    with record_queries() as log:
+        ...
+    log.statements  # [(sql, секунды), ...]
+
+    with query_budget(2, 'GET /courses'):
+        ...  # QueryBudgetExceeded, если запросов больше двух
+
+Запись идет через contextvar, поэтому в лог попадают только запросы своей задачи:
+параллельные запросы к API не смешиваются. Записи, выполненные писателем
+WRITE_COALESCE в его собственной задаче, в лог не попадают.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryLog:
+    def __init__(self, parent: 'QueryLog | None'=None):
+        self.parent=parent
+        self.statements=[]
+
+    def add(self, statement: str, seconds: float):
+        log=self
+        # вложенные логи: запрос виден и во внешнем, например профиль внутри проверки бюджета
+        while log is not None:
+            log.statements.append((statement, seconds))
+            log=log.parent
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def seconds(self):
+        return sum(seconds for _, seconds in self.statements)
+
+
+_current_log=contextvars.ContextVar('query_log', default=None)
+
+
+@contextmanager
+def record_queries():
+    log=QueryLog(_current_log.get())
+    token=_current_log.set(log)
+    try:
+        yield log
+    finally:
+        _current_log.reset(token)
+
+
+@contextmanager
+def query_budget(limit: int, label: str=''):
+    with record_queries() as log:
+        yield log
+    if log.count>limit:
+        statements='\n'.join(f'  {" ".join(statement.split())[:200]}' for statement, _ in log.statements)
+        raise QueryBudgetExceeded(f'{label or "блок"}: {log.count} SQL-запросов, бюджет {limit}\n{statements}')
+
+
+def instrument_engine(engine):
+    # без активного лога слушатели только читают contextvar
+    sync_engine=engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def query_started(conn, cursor, statement, parameters, context, executemany):
+        if _current_log.get() is not None:
+            conn.info.setdefault('querylog_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def query_finished(conn, cursor, statement, parameters, context, executemany):
+        log=_current_log.get()
+        if log is not None:
+            log.add(statement, time.perf_counter()-conn.info['querylog_started'].pop())
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def query_failed(exception_context):
+        connection=exception_context.connection
+        if _current_log.get() is not None and connection is not None and connection.info.get('querylog_started'):
+            connection.info['querylog_started'].pop()
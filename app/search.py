@@ -0,0 +1,118 @@
+"""Полнотекстовый поиск по курсам и материалам на SQLite FTS5.
+
+CourseSearch и MaterialSearch - виртуальные таблицы FTS5 (миграция 5), rowid строки
+совпадает с id курса или материала. Курсы синхронизируют триггеры. У материалов
+триггер только удаляет строку индекса, включая каскадные удаления. Текст материала
+хранится сжатым, SQL его не прочитает, поэтому при вставке и изменении индекс
+обновляет CRUD в той же транзакции.
+
+По умолчанию по bm25 ранжируются все совпадения. bm25 считается для каждого из них,
+и на частом слове в миллионе материалов это секунды. SEARCH_RANK_WINDOW>0 ограничивает
+ранжирование последними совпадениями по rowid: нижняя граница rowid находится по списку
+документов без ранжирования, а FTS5 ограничивает по ней просмотр. Более старые
+совпадения тогда не попадают в выдачу ни на одной странице, и ответ помечается
+truncated. Для редких слов окно не срабатывает.
+
+title и snippet экранируются для HTML, выделение <b></b> вставляется после экранирования.
+"""
+import html
+import os
+import re
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.db import Material
+
+SEARCH_RANK_WINDOW=int(os.getenv('SEARCH_RANK_WINDOW', 0))  # 0 - ранжировать все совпадения
+SNIPPET_TOKENS=16
+HIGHLIGHT_START, HIGHLIGHT_END='<b>', '</b>'
+# метки выделения из FTS5: символы из области частного использования, в тексте их не бывает,
+# и html.escape их не трогает
+_MARK_START, _MARK_END='\ue000', '\ue001'
+
+
+def _highlighted(value: str | None):
+    # текст пользователя экранируется, затем метки FTS5 заменяются на теги выделения
+    if value is None:
+        return ''
+    value=html.escape(value)
+    return value.replace(_MARK_START, HIGHLIGHT_START).replace(_MARK_END, HIGHLIGHT_END)
+
+
+def match_query(q: str):
+    # ввод пользователя не передаем в MATCH как есть: кавычки и операторы FTS5 дали бы ошибку
+    # синтаксиса. Каждое слово в кавычках, слово* - поиск по префиксу. Префикс только по
+    # явному *, короткий префикс разворачивается в тысячи слов
+    terms=re.findall(r'(\w+)(\*?)', q)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"{star}' for term, star in terms)
+
+
+async def index_materials(rows: list[dict], session: AsyncSession):
+    # rows: id, course_id, title, content. Без commit
+    if not rows:
+        return
+    query=text('INSERT OR REPLACE INTO MaterialSearch (rowid, title, body, course_id) VALUES (:id, :title, :content, :course_id)')
+    await session.execute(query, rows)
+
+
+def _hits_query(table: str, course_filter: bool, window: bool):
+    course_condition=' AND course_id = :course_id' if course_filter else ''
+    columns=(
+        f'SELECT rowid AS id, rank, '
+        f"highlight({table}, 0, :start, :end) AS title, snippet({table}, 1, :start, :end, '…', :tokens) AS snippet"
+    )
+    if not window:
+        return text(f'{columns}, 0 AS truncated FROM {table} WHERE {table} MATCH :match{course_condition} ORDER BY rank LIMIT :limit')
+    window_floor=(
+        f'SELECT rowid FROM {table} WHERE {table} MATCH :match{course_condition} '
+        f'ORDER BY rowid DESC LIMIT 1 OFFSET :window'
+    )
+    # truncated - совпадений больше окна, более старые не ранжировались
+    return text(
+        f'WITH floor AS ({window_floor}) '
+        f'{columns}, (SELECT count(*) FROM floor) AS truncated '
+        f'FROM {table} WHERE {table} MATCH :match{course_condition} '
+        f'AND rowid >= coalesce((SELECT rowid FROM floor), 0) '
+        f'ORDER BY rank LIMIT :limit'
+    )
+
+async def search(q: str, kind: str, course_id: int | None, limit: int, offset: int, session: AsyncSession):
+    """Курсы и материалы по релевантности bm25 (меньше rank - выше в выдаче).
+
+    Возвращает (страница, next_offset, truncated). Из каждой таблицы берется не больше
+    offset+limit лучших строк, затем они сливаются по rank. truncated - часть совпадений
+    не ранжировалась из-за SEARCH_RANK_WINDOW.
+    """
+    match=match_query(q)
+    if match is None:
+        return [], None, False
+
+    params={'match': match, 'start': _MARK_START, 'end': _MARK_END, 'tokens': SNIPPET_TOKENS,
+            'limit': offset+limit+1, 'course_id': course_id, 'window': SEARCH_RANK_WINDOW}
+    window=SEARCH_RANK_WINDOW>0
+    hits=[]
+    truncated=False
+    for hit_kind, table, course_filter in (('course', 'CourseSearch', False), ('material', 'MaterialSearch', course_id is not None)):
+        if kind not in ('all', hit_kind) or (hit_kind=='course' and course_id is not None):
+            continue
+        result=await session.execute(_hits_query(table, course_filter, window), params)
+        for row in result.all():
+            truncated=truncated or bool(row.truncated)
+            hits.append({'kind': hit_kind, 'id': row.id, 'rank': row.rank, 'title': _highlighted(row.title), 'snippet': _highlighted(row.snippet),
+                         'course_id': row.id if hit_kind=='course' else None, 'counter': None})
+
+    hits.sort(key=lambda hit: hit['rank'])
+    page=hits[offset:offset+limit]
+    next_offset=offset+limit if len(hits)>offset+limit else None
+
+    material_ids=[hit['id'] for hit in page if hit['kind']=='material']
+    if material_ids:
+        result=await session.execute(select(Material.id, Material.course_id, Material.counter).where(Material.id.in_(material_ids)))
+        locations={material_id: (material_course_id, counter) for material_id, material_course_id, counter in result.all()}
+        for hit in page:
+            if hit['kind']=='material':
+                hit['course_id'], hit['counter']=locations.get(hit['id'], (None, None))
+    return page, next_offset, truncated
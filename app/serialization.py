@@ -0,0 +1,34 @@
+"""Сериализация ответов сразу в байты через pydantic-core.
+
+Списки строк из БД валидируются одним вызовом TypeAdapter (а не model_validate
+на каждую строку) и сразу пишутся в JSON, минуя jsonable_encoder и json.dumps.
+"""
+import functools
+from typing import Any
+
+import pydantic_core
+from fastapi import Response
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+
+@functools.cache
+def adapter(response_model) -> TypeAdapter:
+    # TypeAdapter строит схему при создании, поэтому на каждый тип он один на процесс
+    return TypeAdapter(response_model)
+
+def dump_json(response_model, value) -> bytes:
+    # value может быть ORM-объектами, строками Row или словарями с ними
+    type_adapter=adapter(response_model)
+    return type_adapter.dump_json(type_adapter.validate_python(value, from_attributes=True))
+
+def json_response(response_model, value, status_code: int=200, headers: dict | None=None):
+    return Response(content=dump_json(response_model, value), status_code=status_code, headers=headers,
+                    media_type='application/json')
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse, который пишет JSON через pydantic-core, а не json.dumps."""
+
+    def render(self, content: Any) -> bytes:
+        return pydantic_core.to_json(content)
@@ -0,0 +1,184 @@
+"""Синтетический набор данных для нагрузочных тестов.
+
+Заполняет базу напрямую через SQL, минуя API: пользователи, курсы, материалы,
+отметки прогресса, счетчики аналитики и поисковый индекс - все в том же виде, в
+каком их оставило бы приложение. У всех пользователей один пароль, хеш bcrypt
+считается один раз с текущим BCRYPT_ROUNDS.
+
+Каждый пользователь записан на --enrollments случайных курсов и прошел долю
+--progress-density материалов каждого из них.
+
+    python -m benchmarks.dataset --out bench.db --users 10000 --courses 1000
+"""
+import argparse
+import datetime
+import random
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import create_engine
+
+from app.database.compression import compress_text
+from app.database.migrations import upgrade
+from app.database.ordering import POSITION_STEP
+
+PASSWORD = 'benchmark-password'
+START_DATE = datetime.date(2025, 9, 1)
+WORDS = [f'тема{i}' for i in range(2000)]
+CHUNK = 50_000
+
+
+@dataclass(frozen=True)
+class DatasetParams:
+    users: int = 2000
+    courses: int = 200
+    materials_per_course: int = 20
+    enrollments: int = 5
+    progress_density: float = 0.5
+    content_words: int = 60
+    seed: int = 1
+
+
+@dataclass(frozen=True)
+class Dataset:
+    params: DatasetParams
+    course_owners: dict[int, int]  # course_id -> owner_id
+    progress_rows: int
+    seconds: float
+
+    def user_name(self, user_id: int):
+        return f'user{user_id}'
+
+
+def _text(rng: random.Random, words: int):
+    return ' '.join(rng.choices(WORDS, k=words))
+
+
+def seed(conn, params: DatasetParams):
+    from app.auth import get_password_hash
+
+    started = time.perf_counter()
+    rng = random.Random(params.seed)
+    hashed_password = get_password_hash(PASSWORD)
+
+    conn.exec_driver_sql('INSERT INTO Users (id, name, hashed_password) VALUES (?, ?, ?)',
+                         [(user_id, f'user{user_id}', hashed_password) for user_id in range(1, params.users + 1)])
+
+    course_owners = {course_id: rng.randint(1, params.users) for course_id in range(1, params.courses + 1)}
+    # строки CourseSearch добавляют триггеры миграции 5
+    conn.exec_driver_sql('INSERT INTO Courses (id, title, description, owner_id) VALUES (?, ?, ?, ?)',
+                         [(course_id, f'Курс {course_id} {_text(rng, 2)}', _text(rng, 12), owner_id)
+                          for course_id, owner_id in course_owners.items()])
+
+    rows = []
+    for course_id in course_owners:
+        for counter in range(1, params.materials_per_course + 1):
+            material_id = (course_id - 1) * params.materials_per_course + counter
+            date_lesson = START_DATE + datetime.timedelta(days=counter * 7 + course_id % 7)
+            rows.append((material_id, f'Занятие {counter} {_text(rng, 2)}', _text(rng, params.content_words),
+                         course_id, date_lesson.isoformat(), counter))
+            if len(rows) >= CHUNK:
+                _insert_materials(conn, rows)
+                rows = []
+    _insert_materials(conn, rows)
+
+    progress_rows = _seed_progress(conn, params, rng)
+    return Dataset(params, course_owners, progress_rows, time.perf_counter() - started)
+
+
+def _insert_materials(conn, rows):
+    if not rows:
+        return
+    conn.exec_driver_sql('INSERT INTO Materials (id, title, content, course_id, date_lesson, counter, position) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         [(material_id, title, compress_text(content), course_id, date_lesson, counter, counter * POSITION_STEP)
+                          for material_id, title, content, course_id, date_lesson, counter in rows])
+    conn.exec_driver_sql('INSERT INTO MaterialSearch (rowid, title, body, course_id) VALUES (?, ?, ?, ?)',
+                         [(material_id, title, content, course_id) for material_id, title, content, course_id, _, _ in rows])
+
+
+def _seed_progress(conn, params: DatasetParams, rng: random.Random):
+    # счетчики аналитики считаются здесь же, как их вел бы analytics.record_progress
+    per_course = params.materials_per_course
+    completed_per_material = {}
+    distribution = {}
+    progress, course_users = [], []
+    progress_id = 0
+    enrollments = min(params.enrollments, params.courses)
+
+    def flush():
+        if not progress:
+            return
+        conn.exec_driver_sql('INSERT INTO Progress (id, user_id, material_id, completed) VALUES (?, ?, ?, 1)', progress)
+        conn.exec_driver_sql('INSERT INTO CourseUserStats (course_id, user_id, completed) VALUES (?, ?, ?)', course_users)
+        progress.clear()
+        course_users.clear()
+
+    for user_id in range(1, params.users + 1):
+        for course_id in rng.sample(range(1, params.courses + 1), enrollments):
+            completed = round(per_course * params.progress_density)
+            if not completed:
+                continue
+            for counter in rng.sample(range(1, per_course + 1), completed):
+                material_id = (course_id - 1) * per_course + counter
+                progress_id += 1
+                progress.append((progress_id, user_id, material_id))
+                completed_per_material[material_id] = completed_per_material.get(material_id, 0) + 1
+            course_users.append((course_id, user_id, completed))
+            distribution[course_id, completed] = distribution.get((course_id, completed), 0) + 1
+        if len(progress) >= CHUNK:
+            flush()
+    flush()
+
+    conn.exec_driver_sql('INSERT INTO MaterialStats (material_id, course_id, completed) VALUES (?, ?, ?)',
+                         [(material_id, (material_id - 1) // per_course + 1, completed)
+                          for material_id, completed in completed_per_material.items()])
+    conn.exec_driver_sql('INSERT INTO CourseCompletionStats (course_id, completed, students) VALUES (?, ?, ?)',
+                         [(course_id, completed, students) for (course_id, completed), students in distribution.items()])
+    return progress_id
+
+
+def create(path: str, params: DatasetParams):
+    # app.database.db при импорте создает движки по DATABASE_URL, поэтому импорт здесь:
+    # benchmarks.load успевает указать временную базу
+    from app.database.db import Base
+
+    # база со всеми миграциями, как после create_tables
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        upgrade(conn)
+        dataset = seed(conn, params)
+    engine.dispose()
+    return dataset
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = DatasetParams()
+    parser.add_argument('--users', type=int, default=defaults.users)
+    parser.add_argument('--courses', type=int, default=defaults.courses)
+    parser.add_argument('--materials-per-course', type=int, default=defaults.materials_per_course)
+    parser.add_argument('--enrollments', type=int, default=defaults.enrollments, help='курсов с отметками у каждого пользователя')
+    parser.add_argument('--progress-density', type=float, default=defaults.progress_density,
+                        help='доля пройденных материалов в каждом из этих курсов, 0..1')
+    parser.add_argument('--content-words', type=int, default=defaults.content_words)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def params_from_args(args: argparse.Namespace):
+    return DatasetParams(args.users, args.courses, args.materials_per_course, args.enrollments,
+                         args.progress_density, args.content_words, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', required=True, help='путь к новому файлу базы')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    dataset = create(args.out, params_from_args(args))
+    print(f'{args.users} пользователей, {args.courses} курсов, {args.courses * args.materials_per_course} материалов, '
+          f'{dataset.progress_rows} отметок прогресса за {dataset.seconds:.1f} с')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Задержка выборок из crud до и после миграции с индексами.
+
+Создает временную SQLite-базу со старой схемой (без индексов), заполняет ее
+синтетическими данными, замеряет запросы, затем применяет migrations.upgrade
+и замеряет их снова.
+
+    python -m benchmarks.indexes --progress-rows 1000000
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select, and_
+from sqlalchemy.orm import Session
+
+from app.database.db import Base, Course, Material, Progress
+from app.database.migrations import upgrade
+from app.database.ordering import POSITION_STEP
+
+
+def seed(conn, users: int, courses: int, materials_per_course: int, progress_rows: int):
+    conn.exec_driver_sql('DROP INDEX ix_courses_owner_id')
+    conn.exec_driver_sql('DROP INDEX uq_materials_course_counter')
+    conn.exec_driver_sql('DROP INDEX ix_materials_course_date_lesson')
+    conn.exec_driver_sql('DROP INDEX ix_materials_date_lesson_course')
+    conn.exec_driver_sql('DROP INDEX ix_materials_course_position')
+    conn.exec_driver_sql('DROP INDEX uq_progress_user_material')
+    conn.exec_driver_sql('DROP INDEX ix_progress_material_id')
+
+    conn.exec_driver_sql('INSERT INTO Users (id, name, hashed_password) VALUES (?, ?, ?)',
+                         [(i, f'user{i}', '') for i in range(1, users + 1)])
+    conn.exec_driver_sql('INSERT INTO Courses (id, title, description, owner_id) VALUES (?, ?, ?, ?)',
+                         [(i, f'course{i}', '', random.randint(1, users)) for i in range(1, courses + 1)])
+
+    start = datetime.date(2025, 1, 1)
+    materials = []
+    for course_id in range(1, courses + 1):
+        for counter in range(1, materials_per_course + 1):
+            materials.append((len(materials) + 1, f'material{counter}', '', course_id,
+                              (start + datetime.timedelta(days=random.randint(0, 365))).isoformat(), counter, counter * POSITION_STEP))
+    conn.exec_driver_sql('INSERT INTO Materials (id, title, content, course_id, date_lesson, counter, position) VALUES (?, ?, ?, ?, ?, ?, ?)', materials)
+
+    total_materials = len(materials)
+    # пары (user_id, material_id) без повторов: i-я строка -> i-я клетка матрицы пользователи x материалы
+    step = max(1, users * total_materials // progress_rows)
+    for chunk_start in range(0, progress_rows, 100_000):
+        rows = [(n + 1, n * step // total_materials % users + 1, n * step % total_materials + 1)
+                for n in range(chunk_start, min(chunk_start + 100_000, progress_rows))]
+        conn.exec_driver_sql('INSERT INTO Progress (id, user_id, material_id, completed) VALUES (?, ?, ?, 1)', rows)
+    return total_materials
+
+
+def measure(session: Session, users: int, courses: int, materials_per_course: int, total_materials: int, lookups: int):
+    queries = {
+        'get_progress_user_material': lambda: select(Progress).where(and_(
+            Progress.user_id == random.randint(1, users), Progress.material_id == random.randint(1, total_materials))),
+        'get_material_by_counter': lambda: select(Material).where(and_(
+            Material.course_id == random.randint(1, courses), Material.counter == random.randint(1, materials_per_course))),
+        'user_courses': lambda: select(Course).where(Course.owner_id == random.randint(1, users)),
+        'course_schedule': lambda: select(Material.title, Material.date_lesson).where(
+            Material.course_id == random.randint(1, courses)).order_by(Material.position, Material.counter),
+    }
+
+    results = {}
+    for name, make_query in queries.items():
+        random.seed(name)
+        started = time.perf_counter()
+        for _ in range(lookups):
+            session.execute(make_query()).all()
+        results[name] = (time.perf_counter() - started) / lookups * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--courses', type=int, default=1000)
+    parser.add_argument('--materials-per-course', type=int, default=50)
+    parser.add_argument('--progress-rows', type=int, default=1_000_000)
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f'sqlite:///{os.path.join(directory, "bench.db")}')
+        Base.metadata.create_all(engine)
+
+        random.seed(0)
+        with engine.begin() as conn:
+            total_materials = seed(conn, args.users, args.courses, args.materials_per_course, args.progress_rows)
+
+        with Session(engine) as session:
+            before = measure(session, args.users, args.courses, args.materials_per_course, total_materials, args.lookups)
+
+        with engine.begin() as conn:
+            upgrade(conn)
+
+        with Session(engine) as session:
+            after = measure(session, args.users, args.courses, args.materials_per_course, total_materials, args.lookups)
+        engine.dispose()
+
+    print(f'{args.progress_rows} строк Progress, {total_materials} материалов, {args.lookups} запросов на замер')
+    print(f'{"запрос":<30}{"до, мс":>12}{"после, мс":>12}{"ускорение":>12}')
+    for name in before:
+        print(f'{name:<30}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / after[name]:>11.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+"""Нагрузочный тест API в одном процессе: запросы идут в app через ASGI, без сети.
+
+Создает временную базу с синтетическими данными (benchmarks.dataset), запускает
+lifespan приложения и по очереди прогоняет сценарии - взвешенные смеси запросов:
+
+- login: вход пользователей (bcrypt с текущим BCRYPT_ROUNDS)
+- browse: каталог курсов, страницы курсов и материалов, расписание, поиск
+- progress: отметки прогресса по одному и пачкой, свой прогресс
+- edits: владельцы меняют курсы и материалы, добавляют материалы, смотрят аналитику
+- mixed: все вместе
+
+По каждому маршруту - число запросов, коды ответов, p50/p95/p99 и среднее число SQL-
+запросов на запрос, по сценарию - пропускная способность. Результат пишется в JSON с
+отсортированными ключами, два файла с разных коммитов удобно сравнивать diff'ом.
+Настройки приложения (WRITE_COALESCE, SQLITE_*, BCRYPT_ROUNDS...) берутся из окружения.
+
+    python -m benchmarks.load --scenarios browse,progress --requests 2000 --concurrency 32 --out load.json
+"""
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+from app.querylog import record_queries
+from benchmarks import dataset as synthetic
+
+@dataclasses.dataclass
+class Operation:
+    route: str
+    call: object  # async (client, ctx) -> httpx.Response
+    expected: tuple[int, ...] = (200,)
+
+
+OPERATIONS = {}
+
+
+def operation(route: str, expected: tuple[int, ...] = (200,)):
+    def register(call):
+        OPERATIONS[call.__name__] = Operation(route, call, expected)
+        return call
+    return register
+
+
+class Context:
+    def __init__(self, data: synthetic.Dataset, create_token):
+        self.data = data
+        self.params = data.params
+        self.rng = random.Random(data.params.seed)
+        self._create_token = create_token
+        self._headers = {}
+
+    def headers(self, user_id: int):
+        # токены выдаются без /login, чтобы bcrypt был только в сценарии login
+        if user_id not in self._headers:
+            self._headers[user_id] = {'Authorization': f'Bearer {self._create_token({"sub": self.data.user_name(user_id)})}'}
+        return self._headers[user_id]
+
+    def user(self):
+        return self.rng.randint(1, self.params.users)
+
+    def course(self):
+        return self.rng.randint(1, self.params.courses)
+
+    def counter(self):
+        return self.rng.randint(1, self.params.materials_per_course)
+
+    def owned_course(self):
+        course_id = self.course()
+        return course_id, self.headers(self.data.course_owners[course_id])
+
+    def word(self):
+        # слова из начала словаря встречаются чаще
+        return synthetic.WORDS[min(int(self.rng.expovariate(1 / 200)), len(synthetic.WORDS) - 1)]
+
+
+@operation('POST /login')
+async def login(client, ctx: Context):
+    name = ctx.data.user_name(ctx.user())
+    return await client.post('/login', data={'username': name, 'password': synthetic.PASSWORD})
+
+@operation('GET /courses')
+async def courses_page(client, ctx: Context):
+    return await client.get('/courses', params={'cursor': ctx.rng.randint(0, ctx.params.courses), 'limit': 50})
+
+@operation('GET /courses/{course_id}')
+async def course_info(client, ctx: Context):
+    return await client.get(f'/courses/{ctx.course()}', headers=ctx.headers(ctx.user()))
+
+@operation('GET /courses/{course_id}/{material_counter}')
+async def material(client, ctx: Context):
+    return await client.get(f'/courses/{ctx.course()}/{ctx.counter()}', headers=ctx.headers(ctx.user()))
+
+@operation('GET /schedule/{course_id}')
+async def schedule(client, ctx: Context):
+    return await client.get(f'/schedule/{ctx.course()}', headers=ctx.headers(ctx.user()))
+
+@operation('GET /search')
+async def search(client, ctx: Context):
+    return await client.get('/search', params={'q': ctx.word(), 'limit': 20})
+
+@operation('POST /courses/{course_id}/{material_counter}', expected=(200, 409))
+async def mark_progress(client, ctx: Context):
+    return await client.post(f'/courses/{ctx.course()}/{ctx.counter()}', headers=ctx.headers(ctx.user()))
+
+@operation('POST /progress/{course_id}')
+async def mark_progress_batch(client, ctx: Context):
+    counters = ctx.rng.sample(range(1, ctx.params.materials_per_course + 1), min(5, ctx.params.materials_per_course))
+    return await client.post(f'/progress/{ctx.course()}', json={'counters': counters}, headers=ctx.headers(ctx.user()))
+
+@operation('GET /progress')
+async def my_progress(client, ctx: Context):
+    return await client.get('/progress', headers=ctx.headers(ctx.user()))
+
+@operation('PUT /courses/{course_id}')
+async def update_course(client, ctx: Context):
+    course_id, headers = ctx.owned_course()
+    return await client.put(f'/courses/{course_id}', json={'description': f'Описание {ctx.word()} {ctx.word()}'}, headers=headers)
+
+@operation('POST /courses/{course_id}')
+async def add_material(client, ctx: Context):
+    course_id, headers = ctx.owned_course()
+    body = {'title': f'Дополнительное занятие {ctx.word()}', 'content': ' '.join(ctx.word() for _ in range(ctx.params.content_words)),
+            'date_lesson': (synthetic.START_DATE + datetime.timedelta(days=ctx.rng.randint(0, 365))).isoformat()}
+    return await client.post(f'/courses/{course_id}', json=body, headers=headers)
+
+@operation('PUT /courses/{course_id}/{material_counter}')
+async def update_material(client, ctx: Context):
+    course_id, headers = ctx.owned_course()
+    body = {'content': ' '.join(ctx.word() for _ in range(ctx.params.content_words))}
+    return await client.put(f'/courses/{course_id}/{ctx.counter()}', json=body, headers=headers)
+
+@operation('GET /analytics/{course_id}/students')
+async def course_analytics(client, ctx: Context):
+    course_id, headers = ctx.owned_course()
+    return await client.get(f'/analytics/{course_id}/students', headers=headers)
+
+
+# сценарий: имя операции -> вес
+SCENARIOS = {
+    'login': {'login': 1},
+    'browse': {'courses_page': 4, 'course_info': 2, 'material': 3, 'schedule': 1, 'search': 1},
+    'progress': {'mark_progress': 4, 'mark_progress_batch': 1, 'my_progress': 2, 'material': 2},
+    'edits': {'update_course': 1, 'add_material': 2, 'update_material': 2, 'course_analytics': 1, 'course_info': 2},
+}
+SCENARIOS['mixed'] = {'login': 1, **{name: weight for mix in list(SCENARIOS.values())[1:] for name, weight in mix.items()},
+                      'mark_progress': 6, 'courses_page': 6}
+
+
+def percentile(values: list[float], p: float):
+    # по рангу: значение, не меньше которого p% выборки
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.queries = 0
+        self.errors = 0
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            'count': count,
+            'errors': self.errors,
+            'statuses': {str(code): n for code, n in self.statuses.items()},
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3) if count else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3) if count else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3) if count else None,
+            'max_ms': round(latencies[-1] * 1000, 3) if count else None,
+            'queries_per_request': round(self.queries / count, 2) if count else None,
+        }
+
+
+async def run_scenario(client: httpx.AsyncClient, ctx: Context, mix: dict[str, int], requests: int, concurrency: int,
+                       all_queries, record: bool=True):
+    # лог SQL каждого запроса к API вложен в all_queries - лог всего прогона, куда попадают
+    # и запросы фоновых задач (писатель WRITE_COALESCE, удаление)
+    operations = [OPERATIONS[name] for name in mix]
+    weights = list(mix.values())
+    routes = {}
+    remaining = [requests]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            op = ctx.rng.choices(operations, weights)[0]
+            with record_queries() as log:
+                started = time.perf_counter()
+                try:
+                    response = await op.call(client, ctx)
+                    status_code = response.status_code
+                except Exception as e:
+                    status_code = type(e).__name__
+                elapsed = time.perf_counter() - started
+            if not record:
+                continue
+            stats = routes.setdefault(op.route, RouteStats())
+            stats.latencies.append(elapsed)
+            stats.statuses[status_code] += 1
+            stats.queries += log.count
+            if status_code not in op.expected:
+                stats.errors += 1
+
+    queries_before = all_queries.count
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+
+    total = sum(len(stats.latencies) for stats in routes.values())
+    request_queries = sum(stats.queries for stats in routes.values())
+    return {
+        'requests': total,
+        'errors': sum(stats.errors for stats in routes.values()),
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(total / seconds, 1) if seconds else None,
+        'queries_per_request': round(request_queries / total, 2) if total else None,
+        'background_queries': all_queries.count - queries_before - request_queries,
+        'routes': {route: stats.report() for route, stats in sorted(routes.items())},
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+async def run(args, data: synthetic.Dataset):
+    # приложение импортируется после того, как DATABASE_URL указывает на временную базу
+    from app.auth import BCRYPT_ROUNDS, create_token
+    from app.coalescer import write_coalescer
+    from app.main import app
+
+    ctx = Context(data, create_token)
+    scenarios = {}
+    # лог открыт до lifespan: задача писателя WRITE_COALESCE наследует его контекст
+    with record_queries() as all_queries:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+                for name in args.scenarios:
+                    await run_scenario(client, ctx, SCENARIOS[name], args.warmup, args.concurrency, all_queries, record=False)
+                    scenarios[name] = await run_scenario(client, ctx, SCENARIOS[name], args.requests, args.concurrency, all_queries)
+                    print(f'{name}: {scenarios[name]["throughput_rps"]} запросов/с, ошибок {scenarios[name]["errors"]}', file=sys.stderr)
+            write_stats = write_coalescer.stats()
+
+    commit, dirty = git_commit()
+    return {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'dataset': dataclasses.asdict(data.params),
+            'progress_rows': data.progress_rows,
+            'seed_seconds': round(data.seconds, 1),
+            'settings': {name: os.environ[name] for name in sorted(os.environ)
+                         if name.startswith(('SQLITE_', 'DB_', 'WRITE_COALESCE', 'HASH_', 'RESPONSE_CACHE', 'SEARCH_'))},
+            'bcrypt_rounds': BCRYPT_ROUNDS,
+        },
+        'scenarios': scenarios,
+        'write_coalescer': write_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default='login,browse,progress,edits,mixed',
+                        help=f'через запятую, из: {", ".join(SCENARIOS)}')
+    parser.add_argument('--requests', type=int, default=2000, help='запросов на сценарий')
+    parser.add_argument('--warmup', type=int, default=100, help='запросов на прогрев перед каждым сценарием, в отчет не входят')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--out', default='load.json')
+    synthetic.add_arguments(parser)
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(unknown)}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'load.db')
+        os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{path}'
+        data = synthetic.create(path, synthetic.params_from_args(args))
+        print(f'данные: {data.progress_rows} отметок прогресса, {data.seconds:.1f} с', file=sys.stderr)
+        report = asyncio.run(run(args, data))
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+
+    print(f'{"сценарий / маршрут":<52}{"запросов":>9}{"p50 мс":>9}{"p95 мс":>9}{"p99 мс":>9}{"SQL":>7}')
+    for name, scenario in report['scenarios'].items():
+        print(f'{name} ({scenario["throughput_rps"]} запросов/с, ошибок {scenario["errors"]})')
+        for route, stats in scenario['routes'].items():
+            print(f'  {route:<50}{stats["count"]:>9}{stats["p50_ms"]:>9.2f}{stats["p95_ms"]:>9.2f}'
+                  f'{stats["p99_ms"]:>9.2f}{stats["queries_per_request"]:>7.1f}')
+    print(f'отчет: {args.out}')
+
+
+if __name__ == '__main__':
+    main()
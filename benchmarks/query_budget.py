@@ -0,0 +1,161 @@
+"""Проверка бюджета SQL-запросов по маршрутам.
+
+Для каждого маршрута из BUDGETS считает SQL-запросы одного запроса к API на
+синтетических базах двух размеров (benchmarks.dataset, вторая в --factor раз
+больше). Проверка не проходит, если запросов больше бюджета или если их число
+растет вместе с данными - так выглядит N+1. Кеш ответов выключен, пользователь
+уже в кеше авторизации: считаются запросы самого обработчика.
+
+Каждый размер считается в отдельном процессе: приложение открывает базу по
+DATABASE_URL при импорте.
+
+    python -m benchmarks.query_budget
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks import dataset as synthetic
+
+# маршрут -> наибольшее допустимое число SQL-запросов
+BUDGETS = {
+    'GET /courses': 2,
+    'GET /courses/{course_id}': 2,
+    'GET /courses/{course_id}/{material_counter}': 2,
+    'GET /courses/{course_id}/{material_counter}/content': 1,
+    'GET /schedule/{course_id}': 2,
+    'GET /materials': 1,
+    'GET /user/{user_id}': 1,
+    'GET /progress': 1,
+    'GET /progress/{course_id}': 1,
+    'GET /upcoming': 1,
+    'GET /search': 3,
+    'GET /analytics/{course_id}/materials': 2,
+    'GET /analytics/{course_id}/students': 3,
+    'POST /courses/{course_id}/{material_counter}': 4,
+    'POST /progress/{course_id}': 6,
+    'POST /courses/{course_id}/{material_counter}/move': 5,
+    'PUT /courses/{course_id}': 2,
+    'POST /courses/{course_id}': 3,
+    'PUT /courses/{course_id}/{material_counter}': 5,
+    'DELETE /courses/{course_id}': 3,
+}
+
+
+def requests_for(data: synthetic.Dataset):
+    # (маршрут, метод, путь, параметры, тело, id пользователя)
+    params = data.params
+    course_id = 1
+    owner_id = data.course_owners[course_id]
+    student_id = owner_id % params.users + 1
+    per_course = params.materials_per_course
+    return [
+        ('GET /courses', 'GET', '/courses', {'limit': min(500, params.courses)}, None, None),
+        ('GET /courses/{course_id}', 'GET', f'/courses/{course_id}', None, None, student_id),
+        ('GET /courses/{course_id}/{material_counter}', 'GET', f'/courses/{course_id}/{per_course}', None, None, student_id),
+        ('GET /courses/{course_id}/{material_counter}/content', 'GET', f'/courses/{course_id}/{per_course}/content', None, None, student_id),
+        ('GET /schedule/{course_id}', 'GET', f'/schedule/{course_id}', None, None, student_id),
+        ('GET /materials', 'GET', '/materials', {'course_id': course_id}, None, None),
+        ('GET /user/{user_id}', 'GET', f'/user/{owner_id}', None, None, None),
+        ('GET /progress', 'GET', '/progress', None, None, student_id),
+        ('GET /progress/{course_id}', 'GET', f'/progress/{course_id}', None, None, student_id),
+        ('GET /upcoming', 'GET', '/upcoming', {'course_id': list(range(1, min(params.courses, 50) + 1)), 'date_from': synthetic.START_DATE.isoformat(),
+                                               'date_to': (synthetic.START_DATE + datetime.timedelta(days=365)).isoformat()}, None, None),
+        ('GET /search', 'GET', '/search', {'q': 'Занятие', 'limit': 50}, None, None),
+        ('GET /analytics/{course_id}/materials', 'GET', f'/analytics/{course_id}/materials', None, None, owner_id),
+        ('GET /analytics/{course_id}/students', 'GET', f'/analytics/{course_id}/students', {'limit': 500}, None, owner_id),
+        ('POST /courses/{course_id}/{material_counter}', 'POST', f'/courses/{course_id}/{per_course}', None, None, owner_id),
+        ('POST /progress/{course_id}', 'POST', f'/progress/{course_id}', None, {'counters': list(range(1, per_course + 1))}, owner_id),
+        ('POST /courses/{course_id}/{material_counter}/move', 'POST', f'/courses/{course_id}/{per_course}/move', None, {'after': 1}, owner_id),
+        ('PUT /courses/{course_id}', 'PUT', f'/courses/{course_id}', None, {'description': 'Новое описание'}, owner_id),
+        ('POST /courses/{course_id}', 'POST', f'/courses/{course_id}', None,
+         {'title': 'Новый материал', 'content': 'Текст', 'date_lesson': synthetic.START_DATE.isoformat()}, owner_id),
+        ('PUT /courses/{course_id}/{material_counter}', 'PUT', f'/courses/{course_id}/1', None, {'title': 'Новое название'}, owner_id),
+        # последним: курс удаляется вместе с материалами и отметками
+        ('DELETE /courses/{course_id}', 'DELETE', f'/courses/{course_id}', None, None, owner_id),
+    ]
+
+
+async def count_queries(data: synthetic.Dataset):
+    # приложение импортируется после того, как DATABASE_URL указывает на временную базу
+    import httpx
+    from app.auth import create_token
+    from app.main import app
+    from app.querylog import record_queries
+
+    counts = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://budget') as client:
+            for route, method, path, params, body, user_id in requests_for(data):
+                headers = {}
+                if user_id is not None:
+                    headers['Authorization'] = f'Bearer {create_token({"sub": data.user_name(user_id)})}'
+                    await client.get('/progress', headers=headers)  # пользователь попадает в кеш авторизации
+                with record_queries() as log:
+                    response = await client.request(method, path, params=params, json=body, headers=headers)
+                counts[route] = {'queries': log.count, 'status': response.status_code,
+                                 'statements': [' '.join(statement.split())[:300] for statement, _ in log.statements]}
+    return counts
+
+
+def measure(params: synthetic.DatasetParams):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'budget.db')
+        os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{path}'
+        data = synthetic.create(path, params)
+        return asyncio.run(count_queries(data))
+
+
+def scaled(factor: int):
+    return synthetic.DatasetParams(users=50 * factor, courses=20 * factor, materials_per_course=5 * factor,
+                                   enrollments=3, progress_density=0.5, content_words=20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--factor', type=int, default=10, help='во сколько раз вторая база больше первой')
+    parser.add_argument('--measure', type=int, help=argparse.SUPPRESS)  # внутренний режим: один размер, JSON в stdout
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        json.dump(measure(scaled(args.measure)), sys.stdout, ensure_ascii=False)
+        return
+
+    env = {**os.environ, 'RESPONSE_CACHE_BACKEND': 'none', 'WRITE_COALESCE': '0', 'BCRYPT_ROUNDS': '4'}
+    results = []
+    for factor in (1, args.factor):
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.query_budget', '--measure', str(factor)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output))
+    small, large = results
+
+    failures = []
+    print(f'{"маршрут":<56}{"бюджет":>8}{"x1":>6}{f"x{args.factor}":>6}')
+    for route, budget in BUDGETS.items():
+        queries = (small[route]['queries'], large[route]['queries'])
+        problems = []
+        if max(queries) > budget:
+            problems.append('сверх бюджета')
+        if queries[1] > queries[0]:
+            problems.append('растет с данными')
+        if any(result[route]['status'] >= 400 for result in results):
+            problems.append(f'код ответа {large[route]["status"]}')
+        print(f'{route:<56}{budget:>8}{queries[0]:>6}{queries[1]:>6}  {", ".join(problems)}')
+        if problems:
+            failures.append((route, large[route]['statements']))
+
+    for route, statements in failures:
+        print(f'\n{route}:')
+        for statement in statements:
+            print(f'  {statement}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Задержка /search (app.search.search) на большом синтетическом каталоге.
+
+Создает временную базу со всеми миграциями, заполняет Materials и MaterialSearch
+текстами из случайных слов (частоты по закону Ципфа, как в живом тексте) и
+замеряет поиск по редким, средним и частым словам.
+
+    python -m benchmarks.search --materials 1000000
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app.database.db import Base
+from app.database.migrations import upgrade
+from app.database.ordering import POSITION_STEP
+from app.search import search
+
+VOCABULARY = [f'слово{i}' for i in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+
+
+def seed(conn, materials: int, courses: int, words: int):
+    conn.exec_driver_sql("INSERT INTO Users (id, name, hashed_password) VALUES (1, 'owner', '')")
+    conn.exec_driver_sql('INSERT INTO Courses (id, title, description, owner_id) VALUES (?, ?, ?, 1)',
+                         [(i, f'Курс {i}', '') for i in range(1, courses + 1)])
+    date_lesson = datetime.date(2025, 1, 1).isoformat()
+    for chunk_start in range(0, materials, 50_000):
+        rows = []
+        for material_id in range(chunk_start + 1, min(chunk_start + 50_000, materials) + 1):
+            title = ' '.join(random.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=3))
+            content = ' '.join(random.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=words))
+            rows.append((material_id, title, content, material_id % courses + 1, date_lesson, material_id, material_id * POSITION_STEP))
+        # тексты короче CONTENT_COMPRESS_MIN хранятся без сжатия, как и в приложении
+        conn.exec_driver_sql('INSERT INTO Materials (id, title, content, course_id, date_lesson, counter, position) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.exec_driver_sql('INSERT INTO MaterialSearch (rowid, title, body, course_id) VALUES (?, ?, ?, ?)',
+                             [(material_id, title, content, course_id) for material_id, title, content, course_id, _, _, _ in rows])
+
+
+async def measure(url: str, queries: dict[str, str], lookups: int):
+    engine = create_async_engine(url)
+    session_maker = async_sessionmaker(engine)
+    results = {}
+    async with session_maker() as session:
+        for name, q in queries.items():
+            await search(q, 'all', None, 20, 0, session)  # прогрев кеша страниц
+            started = time.perf_counter()
+            for _ in range(lookups):
+                hits, _, _ = await search(q, 'all', None, 20, 0, session)
+            results[name] = ((time.perf_counter() - started) / lookups * 1000, len(hits))
+    await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--materials', type=int, default=1000000)
+    parser.add_argument('--courses', type=int, default=1000)
+    parser.add_argument('--words', type=int, default=40, help='слов в тексте материала')
+    parser.add_argument('--lookups', type=int, default=20)
+    args = parser.parse_args()
+
+    queries = {
+        'редкое слово': VOCABULARY[-1],
+        'среднее слово': VOCABULARY[500],
+        'частое слово': VOCABULARY[5],
+        'два слова': f'{VOCABULARY[50]} {VOCABULARY[300]}',
+        'префикс': VOCABULARY[1234][:-1] + '*',
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        engine = create_engine(f'sqlite:///{path}')
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            upgrade(conn)
+            started = time.perf_counter()
+            seed(conn, args.materials, args.courses, args.words)
+            seeded = time.perf_counter() - started
+        engine.dispose()
+
+        results = asyncio.run(measure(f'sqlite+aiosqlite:///{path}', queries, args.lookups))
+
+    print(f'{args.materials} материалов по {args.words} слов, индекс построен за {seeded:.0f} с')
+    print(f'{"запрос":<20}{"мс":>10}{"найдено":>10}')
+    for name, (ms, found) in results.items():
+        print(f'{name:<20}{ms:>10.2f}{found:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Сериализация списка /materials: прежний путь против TypeAdapter + pydantic-core.
+
+Материалы выбираются из временной SQLite-базы один раз, дальше замеряется только
+превращение ORM-объектов в тело ответа:
+
+- before: MaterialResponse.model_validate на каждую строку, jsonable_encoder, json.dumps
+- after: один validate_python по списку через закешированный TypeAdapter и dump_json
+
+    python -m benchmarks.serialization --rows 10000
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session, undefer
+
+from app.database.db import Base, Material
+from app.database.ordering import POSITION_STEP
+from app.models import MaterialResponse
+from app.serialization import dump_json
+
+
+def seed(conn, rows: int):
+    conn.exec_driver_sql("INSERT INTO Users (id, name, hashed_password) VALUES (1, 'owner', '')")
+    conn.exec_driver_sql("INSERT INTO Courses (id, title, description, owner_id) VALUES (1, 'course', '', 1)")
+    start = datetime.date(2025, 1, 1)
+    conn.exec_driver_sql(
+        'INSERT INTO Materials (id, title, content, course_id, date_lesson, counter, position) VALUES (?, ?, ?, 1, ?, ?, ?)',
+        [(i, f'Материал {i}', 'Содержание занятия ' * 10, (start + datetime.timedelta(days=i % 365)).isoformat(), i, i * POSITION_STEP)
+         for i in range(1, rows + 1)])
+
+
+def before(materials):
+    response = [MaterialResponse.model_validate(material) for material in materials]
+    return json.dumps(jsonable_encoder(response), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def after(materials):
+    return dump_json(list[MaterialResponse], materials)
+
+
+def measure(build, materials, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        build(materials)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f'sqlite:///{os.path.join(directory, "bench.db")}')
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            seed(conn, args.rows)
+
+        with Session(engine) as session:
+            materials = session.execute(select(Material).options(undefer(Material.content))).scalars().all()
+            assert json.loads(before(materials)) == json.loads(after(materials))
+
+            results = {name: measure(build, materials, args.repeat) for name, build in (('before', before), ('after', after))}
+        engine.dispose()
+
+    print(f'/materials, {args.rows} строк, медиана из {args.repeat}')
+    for name, seconds in results.items():
+        print(f'{name:>7}: {seconds * 1000:8.1f} мс  {args.rows / seconds:10.0f} строк/с')
+    print(f'ускорение: {results["before"] / results["after"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()